@@ -4,55 +4,371 @@ import time
 import threading
 import io
 import random
-import websocket
+import asyncio
 import ssl
 import sqlite3
+import hashlib
+import bisect
+import mmap
+import struct
 import psycopg2
-from flask import Flask, render_template_string, request, jsonify, send_file
-from PIL import Image, ImageDraw
+import psycopg2.pool
+import atexit
+import queue
+import glob
+import socket
+import fcntl
+import signal
+import itertools
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from websockets.asyncio.client import connect as ws_connect
+from flask import Flask, render_template_string, request, jsonify
+from PIL import Image, ImageDraw, features
 
 app = Flask(__name__)
 
 # =============================================================================
 # 1. THREAD LOCKS & GLOBALS (CRITICAL FOR SAFETY)
 # =============================================================================
+# --- METRICS (PROMETHEUS TEXT) ---
+# Hand-written, koi client library nahi. observe() = ek bisect + chhota lock,
+# gauges scrape pe hi padhe jaate hain: production me on rakh sakte ho.
+METRICS = []
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *lv, n=1):
+        with self.lock: self.values[lv] = self.values.get(lv, 0) + n
+
+    def samples(self):
+        with self.lock: return [(self.name, tuple(zip(self.labels, lv)), v) for lv, v in self.values.items()]
+
+class Gauge:
+    # fn() -> value, ya labels ho toh {label_values: value}
+    def __init__(self, name, help, fn, labels=(), kind="gauge"):
+        self.name, self.help, self.fn, self.labels, self.kind = name, help, fn, labels, kind
+        METRICS.append(self)
+
+    def samples(self):
+        v = self.fn()
+        if not self.labels: return [(self.name, (), v)]
+        return [(self.name, tuple(zip(self.labels, lv)), x) for lv, x in v.items()]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {} # label values -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *lv):
+        i = bisect.bisect_left(self.buckets, value) # le inclusive hai
+        with self.lock:
+            series = self.values.get(lv)
+            if series is None: series = self.values[lv] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *lv):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - t0, *lv)
+
+    def samples(self):
+        with self.lock: snap = [(lv, list(c), total, n) for lv, (c, total, n) in self.values.items()]
+        out = []
+        for lv, counts, total, n in snap:
+            labels = tuple(zip(self.labels, lv))
+            acc = 0
+            for le, c in zip(self.buckets, counts):
+                acc += c
+                out.append((self.name + "_bucket", labels + (("le", le),), acc))
+            out.append((self.name + "_bucket", labels + (("le", "+Inf"),), n))
+            out.append((self.name + "_sum", labels, total))
+            out.append((self.name + "_count", labels, n))
+        return out
+
+def render_metrics():
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    lines = []
+    for m in METRICS:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        for name, labels, value in m.samples():
+            lab = ",".join(f'{k}="{esc(v)}"' for k, v in labels)
+            lines.append(f"{name}{{{lab}}} {value}" if lab else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+LOCK_WAIT = Histogram("tt_lock_wait_seconds", "Time spent waiting for a contended lock", ("lock",))
+
+class TimedLock:
+    # threading.Lock jaisa; wait sirf contention pe naapa jata hai (fast path = ek try)
+    def __init__(self, name):
+        self.name, self.lock, self.acquired = name, threading.Lock(), 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.lock.acquire(False):
+            if not blocking: return False
+            t0 = time.perf_counter()
+            ok = self.lock.acquire(True, timeout)
+            LOCK_WAIT.observe(time.perf_counter() - t0, self.name)
+            if not ok: return False
+        self.acquired += 1 # lock ke andar, race nahi
+        return True
+
+    def release(self): self.lock.release()
+    def locked(self): return self.lock.locked()
+    def __enter__(self): return self.acquire()
+    def __exit__(self, *exc): self.release()
+
 # Ye locks race conditions ko rokenge.
-DB_LOCK = threading.Lock()
-GAME_LOCK = threading.Lock()
+DB_LOCK = TimedLock("db")
+GAME_LOCK = TimedLock("game")
+Gauge("tt_lock_acquisitions_total", "Lock acquisitions", lambda: {("db",): DB_LOCK.acquired, ("game",): GAME_LOCK.acquired}, ("lock",), "counter")
 
 ASSETS = {}
 
 # =============================================================================
 # 2. ASSET GENERATION (IN-MEMORY)
 # =============================================================================
-def init_assets():
-    # Board (Dark Cyberpunk)
+def board_origin(n):
+    # (offset, cell px): 3x3 purana layout (300px cells), bade boards frame ke andar
+    return (0, 300) if n == 3 else (20, 860 / n)
+
+def init_assets(n=3):
+    # n x n board, canvas hamesha 900px: cell aur line widths n se scale
+    org, cell = board_origin(n)
+    s = 3 / n
     board = Image.new('RGB', (900, 900), (15, 15, 20)) 
     draw = ImageDraw.Draw(board)
     grid_color = (0, 243, 255) # Neon Cyan
     
     # Border & Grid
     draw.rectangle([10, 10, 890, 890], outline=grid_color, width=15)
-    for xy in [300, 600]:
-        draw.line([(xy, 20), (xy, 880)], fill=grid_color, width=15)
-        draw.line([(20, xy), (880, xy)], fill=grid_color, width=15)
-    ASSETS['board'] = board
-
+    for i in range(1, n):
+        xy = round(org + i * cell)
+        draw.line([(xy, 20), (xy, 880)], fill=grid_color, width=max(3, round(15 * s)))
+        draw.line([(20, xy), (880, xy)], fill=grid_color, width=max(3, round(15 * s)))
+    if n > 3:
+        # Bade board pe coordinates (a1..) har cell ke kone me, move syntax wahi hai
+        for i in range(n * n):
+            r, c = divmod(i, n)
+            draw.text((round(org + c * cell) + 8, round(org + r * cell) + 6), cell_name(i, n), fill=grid_color)
+
+    size, m, w = round(cell), 60 * s, max(3, round(25 * s))
     # X (Neon Red)
-    x_img = Image.new('RGBA', (300, 300), (0,0,0,0))
+    x_img = Image.new('RGBA', (size, size), (0,0,0,0))
     d_x = ImageDraw.Draw(x_img)
-    d_x.line([(60,60), (240,240)], fill=(255, 0, 60), width=25)
-    d_x.line([(240,60), (60,240)], fill=(255, 0, 60), width=25)
-    ASSETS['x'] = x_img
+    d_x.line([(m, m), (size-m, size-m)], fill=(255, 0, 60), width=w)
+    d_x.line([(size-m, m), (m, size-m)], fill=(255, 0, 60), width=w)
 
     # O (Neon Green)
-    o_img = Image.new('RGBA', (300, 300), (0,0,0,0))
+    o_img = Image.new('RGBA', (size, size), (0,0,0,0))
     d_o = ImageDraw.Draw(o_img)
-    d_o.ellipse([60,60,240,240], outline=(0, 255, 65), width=25)
-    ASSETS['o'] = o_img
+    d_o.ellipse([m, m, size-m, size-m], outline=(0, 255, 65), width=w)
+    ASSETS[n] = (board, x_img, o_img)
 
 init_assets()
 
+# =============================================================================
+# 2B. RENDER CACHE (CONTENT ADDRESSED)
+# =============================================================================
+# Board + win line ke sirf kuch hazaar combinations hain, toh har PNG ek baar
+# encode karke bytes memory me rakh lo. Key normalized hai taaki 't=' jaise
+# extra params ya kachra characters cache ko todein nahi.
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", 4096))
+RENDER_CACHE = OrderedDict() # (board, line, format, size, n) -> (etag, image bytes)
+RENDER_LOCK = threading.Lock()
+RENDER_STATS = {"hits": 0, "misses": 0, "not_modified": 0, "evictions": 0, "pack_hits": 0}
+
+# Output formats: board me sirf 5 rang hain, toh palette PNG (png8) lossless hai
+# aur full RGB PNG se kaafi chhota. WebP tabhi jab Pillow me support ho.
+RENDER_FORMATS = {"png": "image/png", "png8": "image/png"}
+if features.check("webp"): RENDER_FORMATS["webp"] = "image/webp"
+RENDER_SIZES = (900, 450, 300)
+RENDER_FORMAT = os.environ.get("RENDER_FORMAT", "png") # default jab client kuch na maange
+PNG_LEVEL = int(os.environ.get("RENDER_PNG_LEVEL", 6)) # zlib 0-9
+WEBP_METHOD = int(os.environ.get("RENDER_WEBP_METHOD", 4)) # 0 fast .. 6 small
+
+def normalize_render_key(b_str, w_line, fmt="png", size=900, n=3):
+    n = int(n)
+    if not 3 <= n <= BOARD_MAX: raise ValueError("bad board size")
+    b = "".join(c if c in "XO" else "_" for c in b_str[:n*n]).ljust(n*n, "_")
+    w = ""
+    if w_line:
+        # Win line = us run ke saare cells (3x3 pe "0,4,8")
+        idx = [int(k) for k in w_line.split(',')]
+        if not 3 <= len(idx) <= n or not all(0 <= k < n*n for k in idx): raise ValueError("bad win line")
+        w = ",".join(str(k) for k in idx)
+    if fmt not in RENDER_FORMATS: raise ValueError("bad format")
+    size = int(size)
+    if size not in RENDER_SIZES: raise ValueError("bad size")
+    return b, w, fmt, size, n
+
+def draw_board(b, w, n=3):
+    if n not in ASSETS: init_assets(n)
+    board, x_img, o_img = ASSETS[n]
+    base = board.copy()
+    org, cell = board_origin(n)
+    for i, c in enumerate(b):
+        if c in ['X', 'O']:
+            sym = x_img if c == 'X' else o_img
+            base.paste(sym, (round(org + (i%n)*cell), round(org + (i//n)*cell)), sym)
+    if w:
+        draw = ImageDraw.Draw(base)
+        idx = [int(k) for k in w.split(',')]
+        s, e = idx[0], idx[-1]
+        center = lambda i: (round(org + (i%n + 0.5)*cell), round(org + (i//n + 0.5)*cell))
+        draw.line([center(s), center(e)], fill="#ffd700", width=max(3, round(75 / n)))
+    return base
+
+# Board ke saare rang pehle se pata hain -> fixed palette, median-cut ki zarurat nahi
+BOARD_COLORS = [(15, 15, 20), (0, 243, 255), (255, 0, 60), (0, 255, 65), (255, 215, 0)]
+PALETTE = Image.new('P', (1, 1))
+PALETTE.putpalette([v for c in BOARD_COLORS for v in c])
+
+def encode_image(img, fmt, size=900):
+    # 900 -> 450/300 integer factor hai, reduce() LANCZOS se kaafi tez hai
+    if size != img.width: img = img.reduce(img.width // size)
+    img_io = io.BytesIO()
+    if fmt == "png8":
+        if size == 900: img = img.quantize(palette=PALETTE, dither=Image.Dither.NONE)
+        # Reduce ke baad edges pe beech ke shades bante hain, unko 16 colors do
+        else: img = img.quantize(colors=16, method=Image.Quantize.FASTOCTREE)
+        img.save(img_io, 'PNG', compress_level=PNG_LEVEL)
+    elif fmt == "webp":
+        img.save(img_io, 'WEBP', lossless=True, method=WEBP_METHOD)
+    else:
+        img.save(img_io, 'PNG', compress_level=PNG_LEVEL)
+    return img_io.getvalue()
+
+RENDER_SECONDS = Histogram("tt_render_encode_seconds", "Board draw + encode time (cache misses only)", ("format",))
+RENDER_BYTES = Histogram("tt_render_bytes", "Encoded board size", ("format",), SIZE_BUCKETS)
+
+def encode_board(key):
+    b, w, fmt, size, n = key
+    with RENDER_SECONDS.time(fmt):
+        data = encode_image(draw_board(b, w, n), fmt, size)
+    RENDER_BYTES.observe(len(data), fmt)
+    # Strong ETag = content hash, same bytes -> same tag on every worker
+    return hashlib.sha1(data).hexdigest(), data
+
+def get_render(key):
+    with RENDER_LOCK:
+        hit = RENDER_CACHE.get(key)
+        if hit:
+            RENDER_CACHE.move_to_end(key)
+            RENDER_STATS["hits"] += 1
+            return hit
+        RENDER_STATS["misses"] += 1
+
+    # Pillow kaam lock ke bahar (do miss ek saath aaye toh bhi result same hai)
+    entry = encode_board(key)
+    with RENDER_LOCK:
+        RENDER_CACHE[key] = entry
+        while len(RENDER_CACHE) > RENDER_CACHE_SIZE:
+            RENDER_CACHE.popitem(last=False)
+            RENDER_STATS["evictions"] += 1
+    return entry
+
+# =============================================================================
+# 2C. PRE-RENDERED BOARD PACK (MMAP)
+# =============================================================================
+# 3x3 pe sirf 5478 legal positions hain. `python build_pack.py` sab ko ek file me
+# likh deta hai; RENDER_PACK set ho toh /render seedha mmap slice bhejta hai.
+# Naye gunicorn workers ko kuch render nahi karna padta, pages OS share karta hai.
+# Bade boards (4x4+) pack me nahi, wo render cache se.
+#
+# Format: MAGIC | u32 index_len | index JSON {"board|line|fmt|size|n": [offset, length, etag]} | blobs
+# (offset blob section ki shuruaat se; purane packs me "|n" nahi = 3x3)
+WIN_LINES = [(0,1,2),(3,4,5),(6,7,8),(0,3,6),(1,4,7),(2,5,8),(0,4,8),(2,4,6)]
+PACK_MAGIC = b"TTTPACK1"
+RENDER_PACK = os.environ.get("RENDER_PACK", "")
+PACK = {"index": {}, "view": None}
+
+def find_win_line(b):
+    for x,y,z in WIN_LINES:
+        if b[x]==b[y]==b[z] and b[x] in "XO": return f"{x},{y},{z}"
+    return ""
+
+def iter_positions():
+    # Empty board se X pehle, jeet ya full board pe ruk jao (wahi states jo game bhejta hai)
+    seen = set()
+    stack = ["_"*9]
+    while stack:
+        b = stack.pop()
+        if b in seen: continue
+        seen.add(b)
+        w = find_win_line(b)
+        yield b, w
+        if w or "_" not in b: continue
+        turn = "X" if b.count("X") == b.count("O") else "O"
+        for i, c in enumerate(b):
+            if c == "_": stack.append(b[:i] + turn + b[i+1:])
+
+def build_pack(path, encode=None, jobs=1, variants=(("png", 900),)):
+    encode = encode or encode_board
+    keys = [(b, w, fmt, size, 3) for b, w in iter_positions() for fmt, size in variants]
+    if jobs > 1:
+        import multiprocessing
+        with multiprocessing.Pool(jobs) as pool: results = pool.map(encode, keys, chunksize=64)
+    else: results = map(encode, keys)
+
+    index, blobs, offset = {}, [], 0
+    for key, (etag, data) in zip(keys, results):
+        index["|".join(map(str, key))] = [offset, len(data), etag]
+        blobs.append(data)
+        offset += len(data)
+
+    header = json.dumps(index, separators=(",", ":")).encode()
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(PACK_MAGIC + struct.pack("<I", len(header)) + header)
+        for data in blobs: f.write(data)
+    os.replace(tmp, path)
+    return len(index), offset
+
+def load_pack(path):
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(PACK_MAGIC)] != PACK_MAGIC: raise ValueError("not a board pack")
+        start = len(PACK_MAGIC) + 4
+        (n,) = struct.unpack("<I", mm[len(PACK_MAGIC):start])
+        base = start + n
+        index = {}
+        for k, (off, size, etag) in json.loads(mm[start:base]).items():
+            b, w, fmt, px, n = (k.split("|") + ["3"])[:5]
+            index[(b, w, fmt, int(px), int(n))] = (off + base, size, etag)
+        PACK.update({"index": index, "view": memoryview(mm)})
+        print(f"Board pack loaded: {len(index)} images from {path}")
+    except Exception as e: print("Pack Error:", e)
+
+def get_packed(key):
+    hit = PACK["index"].get(key)
+    if not hit: return None
+    off, size, etag = hit
+    with RENDER_LOCK: RENDER_STATS["pack_hits"] += 1
+    # bytes() ek memcpy hai: WSGI servers (gunicorn) memoryview body nahi lete
+    return etag, bytes(PACK["view"][off:off+size])
+
+if RENDER_PACK: load_pack(RENDER_PACK)
+
 # =============================================================================
 # 3. DATABASE MANAGER (THREAD SAFE)
 # =============================================================================
@@ -60,426 +376,2008 @@ DATABASE_URL = os.environ.get("DATABASE_URL")
 USE_SQLITE = False if DATABASE_URL else True
 
 def get_db():
-    if USE_SQLITE: return sqlite3.connect("titan_ttt.db")
+    if USE_SQLITE: return sqlite3.connect("titan_ttt.db", timeout=DB_POOL_TIMEOUT)
     return psycopg2.connect(DATABASE_URL, sslmode='require')
 
+# --- CONNECTION POOL ---
+# Har command pe naya TCP+TLS handshake mehenga hai. Postgres ke liye bounded
+# pool (semaphore = checkout timeout), SQLite ke liye har thread ka ek
+# persistent WAL connection.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5)) # checkout wait (sec)
+DB_HEALTH_IDLE = float(os.environ.get("DB_HEALTH_IDLE", 30)) # itna idle raha toh SELECT 1 se check
+DB_STATS = {"checkouts": 0, "waits": 0, "wait_ms": 0.0, "max_wait_ms": 0.0, "timeouts": 0,
+            "in_use": 0, "opened": 0, "health_fails": 0}
+DB_STATS_LOCK = threading.Lock()
+DB_LOCAL = threading.local()
+DB_POOL = {"pg": None, "sem": threading.BoundedSemaphore(DB_POOL_SIZE), "last_used": {}}
+
+def _open_sqlite():
+    conn = get_db()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def _checkout_pg():
+    if DB_POOL["pg"] is None:
+        with DB_STATS_LOCK:
+            if DB_POOL["pg"] is None:
+                # minconn == maxconn warna psycopg2 putconn pe connection band kar deta hai
+                DB_POOL["pg"] = psycopg2.pool.ThreadedConnectionPool(DB_POOL_SIZE, DB_POOL_SIZE, DATABASE_URL, sslmode='require')
+    pool = DB_POOL["pg"]
+    conn = pool.getconn()
+    idle_since = DB_POOL["last_used"].get(id(conn))
+    if idle_since is None:
+        with DB_STATS_LOCK: DB_STATS["opened"] += 1
+    elif conn.closed or time.time() - idle_since > DB_HEALTH_IDLE:
+        try:
+            with conn.cursor() as c: c.execute("SELECT 1")
+            conn.rollback()
+        except Exception:
+            with DB_STATS_LOCK: DB_STATS["health_fails"] += 1
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+    return conn
+
+def _checkin_pg(conn, broken):
+    # putconn khud rollback karta hai agar koi transaction khula reh gaya
+    broken = broken or bool(conn.closed)
+    if broken: DB_POOL["last_used"].pop(id(conn), None)
+    else: DB_POOL["last_used"][id(conn)] = time.time()
+    DB_POOL["pg"].putconn(conn, close=broken)
+
+@contextmanager
+def db_conn():
+    sem = DB_POOL["sem"]
+    t0 = time.time()
+    if not sem.acquire(blocking=False):
+        if not sem.acquire(timeout=DB_POOL_TIMEOUT):
+            with DB_STATS_LOCK: DB_STATS["timeouts"] += 1
+            raise TimeoutError("DB pool exhausted")
+        waited = (time.time() - t0) * 1000
+        with DB_STATS_LOCK:
+            DB_STATS["waits"] += 1
+            DB_STATS["wait_ms"] += waited
+            DB_STATS["max_wait_ms"] = max(DB_STATS["max_wait_ms"], waited)
+    with DB_STATS_LOCK:
+        DB_STATS["checkouts"] += 1
+        DB_STATS["in_use"] += 1
+
+    conn, broken = None, False
+    try:
+        if USE_SQLITE:
+            conn = getattr(DB_LOCAL, "conn", None)
+            if conn is None:
+                conn = DB_LOCAL.conn = _open_sqlite()
+                with DB_STATS_LOCK: DB_STATS["opened"] += 1
+        else: conn = _checkout_pg()
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        if conn is not None and USE_SQLITE: conn.rollback()
+        raise
+    finally:
+        if conn is not None:
+            if not USE_SQLITE: _checkin_pg(conn, broken)
+        sem.release()
+        with DB_STATS_LOCK: DB_STATS["in_use"] -= 1
+
 def init_db():
     with DB_LOCK: # Lock DB during init
         try:
-            conn = get_db()
-            c = conn.cursor()
-            c.execute('''CREATE TABLE IF NOT EXISTS tt_players 
-                       (username VARCHAR(255) PRIMARY KEY, wins INTEGER, score INTEGER, avatar_url TEXT)''')
-            conn.commit()
-            conn.close()
+            with db_conn() as conn:
+                c = conn.cursor()
+                c.execute('''CREATE TABLE IF NOT EXISTS tt_players 
+                           (username VARCHAR(255) PRIMARY KEY, wins INTEGER, score INTEGER, avatar_url TEXT)''')
+                c.execute("CREATE INDEX IF NOT EXISTS idx_tt_players_score ON tt_players (score DESC)")
+                conn.commit()
         except Exception as e: print("DB Error:", e)
 
+# --- SCORE LEDGER (WRITE-BEHIND) ---
+# update_score() sirf delta queue karta hai; ek writer thread har user ke
+# deltas jod kar batch me upsert karta hai. Reads pending deltas bhi jodte
+# hain, toh bet check ke liye balance hamesha sahi rehta hai.
+LEDGER_FLUSH_INTERVAL = float(os.environ.get("LEDGER_FLUSH_INTERVAL", 0.5)) # coalesce window (sec)
+LEDGER_BATCH = int(os.environ.get("LEDGER_BATCH", 500)) # rows per transaction
+LEDGER_DRAIN_TIMEOUT = float(os.environ.get("LEDGER_DRAIN_TIMEOUT", 10)) # exit pe max wait (sec)
+LEDGER = {"pending": {}, "inflight": {}, "gen": 0} # user -> [points, wins, avatar]
+LEDGER_LOCK = threading.Condition()
+LEDGER_STATS = {"queued": 0, "flushes": 0, "rows": 0, "errors": 0}
+
+# --- BALANCE CACHE (WRITE-THROUGH LRU) ---
+# Bet check aur !score ke liye DB round trip nahi. Cache me effective balance
+# (DB + pending deltas) rehta hai; None = user ki row abhi bani nahi.
+# Miss ka DB read lock ke bahar: pool wait (DB_POOL_TIMEOUT tak) ke dauran
+# saare rooms ke payouts/refunds na rukein. Read ke beech is user ka update
+# aaya (BALANCE_LOADING version badla) toh wo read phenk ke dobara.
+# Lock order: BALANCE_LOCK -> LEDGER_LOCK.
+BALANCE_CACHE_SIZE = int(os.environ.get("BALANCE_CACHE_SIZE", 10000))
+BALANCE_CACHE = OrderedDict()
+BALANCE_LOCK = threading.RLock()
+BALANCE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "debits": 0, "declined": 0, "stale_reads": 0}
+BALANCE_LOADING = {} # user -> [readers, version] jab tak miss ka DB read chal raha hai
+
+class ScoreReadError(Exception): pass # DB read fail: "row nahi hai" se alag, kabhi cache nahi hota
+
+def get_balance(username):
+    with BALANCE_LOCK:
+        if username in BALANCE_CACHE:
+            BALANCE_CACHE.move_to_end(username)
+            BALANCE_STATS["hits"] += 1
+            return BALANCE_CACHE[username] or 0
+        BALANCE_STATS["misses"] += 1
+    return load_balance(username) or 0
+
+def load_balance(username):
+    # Read fail -> ScoreReadError upar tak, cache me kuch nahi jaata
+    for _ in range(3):
+        with BALANCE_LOCK:
+            if username in BALANCE_CACHE: return BALANCE_CACHE[username]
+            slot = BALANCE_LOADING.setdefault(username, [0, 0])
+            slot[0] += 1
+            version = slot[1]
+        err = None
+        try: bal = get_score(username, raw=True)
+        except ScoreReadError as e: err = e
+        with BALANCE_LOCK:
+            slot[0] -= 1
+            if not slot[0]: del BALANCE_LOADING[username]
+            if err: raise err
+            if username in BALANCE_CACHE: return BALANCE_CACHE[username]
+            if slot[1] != version:
+                BALANCE_STATS["stale_reads"] += 1
+                continue
+            BALANCE_CACHE[username] = bal
+            while len(BALANCE_CACHE) > BALANCE_CACHE_SIZE:
+                BALANCE_CACHE.popitem(last=False)
+                BALANCE_STATS["evictions"] += 1
+            return bal
+    raise ScoreReadError("balance kept changing during read")
+
+def try_debit(username, amount):
+    # Atomic check-and-deduct: do games ek saath same balance kharch nahi kar sakte.
+    # Miss ho toh load pehle (lock ke bahar), check + deduct ek hi lock me.
+    for _ in range(3):
+        try: get_balance(username)
+        except ScoreReadError: break # balance pata nahi toh bet nahi
+        with BALANCE_LOCK:
+            if username not in BALANCE_CACHE: continue # beech me evict ho gaya
+            if (BALANCE_CACHE[username] or 0) < amount: break
+            update_score(username, -amount)
+            BALANCE_STATS["debits"] += 1
+            return True
+    with BALANCE_LOCK: BALANCE_STATS["declined"] += 1
+    return False
+
+def invalidate_balance(username=None):
+    # DB ko seedha chhedo (admin fix, migration) toh ye call karo
+    with BALANCE_LOCK:
+        if username is None: BALANCE_CACHE.clear()
+        else: BALANCE_CACHE.pop(username, None)
+        for u, slot in BALANCE_LOADING.items():
+            if username is None or u == username: slot[1] += 1
+
 # User tabhi add hoga jab score update hoga (Clean Leaderboard)
+SCORE_UPDATE = Histogram("tt_update_score_seconds", "update_score() time (cache + ledger enqueue)")
+SCORE_READ = Histogram("tt_get_score_seconds", "get_score() DB read time")
+LEDGER_WRITE = Histogram("tt_ledger_flush_seconds", "Ledger batch write time")
+
 def update_score(username, points, avatar_url=""):
-    with DB_LOCK: # CRITICAL SECTION: Only one thread can write at a time
-        try:
-            conn = get_db()
-            c = conn.cursor()
-            ph = "?" if USE_SQLITE else "%s"
-            
-            c.execute(f"SELECT score, wins FROM tt_players WHERE username={ph}", (username,))
-            data = c.fetchone()
-            
-            if data:
-                new_score = data[0] + points
-                new_wins = data[1] + (1 if points > 0 else 0)
-                # Update Score and Avatar
-                if avatar_url:
-                    c.execute(f"UPDATE tt_players SET score={ph}, wins={ph}, avatar_url={ph} WHERE username={ph}", 
-                              (new_score, new_wins, avatar_url, username))
-                else:
-                    c.execute(f"UPDATE tt_players SET score={ph}, wins={ph} WHERE username={ph}", 
-                              (new_score, new_wins, username))
-            else:
-                # First time entry (Only if points != 0 usually, but we allow start)
-                # Starting Bonus = 100
-                initial_score = 100 + points
-                initial_wins = 1 if points > 0 else 0
-                c.execute(f"INSERT INTO tt_players (username, score, wins, avatar_url) VALUES ({ph}, {ph}, {ph}, {ph})", 
-                          (username, initial_score, initial_wins, avatar_url))
-            
+    with SCORE_UPDATE.time(), BALANCE_LOCK:
+        if username in BALANCE_CACHE:
+            bal = BALANCE_CACHE[username]
+            BALANCE_CACHE[username] = (100 if bal is None else bal) + points
+        elif username in BALANCE_LOADING: BALANCE_LOADING[username][1] += 1 # chal raha read ab stale
+        rank_apply(username, points, avatar_url)
+        with LEDGER_LOCK:
+            d = LEDGER["pending"].setdefault(username, [0, 0, ""])
+            d[0] += points
+            d[1] += 1 if points > 0 else 0
+            if avatar_url: d[2] = avatar_url
+            LEDGER_STATS["queued"] += 1
+            LEDGER_LOCK.notify()
+
+def pending_delta_unsafe(username):
+    # (points, has_pending) - LEDGER_LOCK ke andar call karo
+    total, found = 0, False
+    for bucket in (LEDGER["pending"], LEDGER["inflight"]):
+        d = bucket.get(username)
+        if d: total += d[0]; found = True
+    return total, found
+
+def write_deltas(deltas):
+    ph = "?" if USE_SQLITE else "%s"
+    # Naya user: 100 starting bonus + delta. Purana: score me delta jodo.
+    sql = (f"INSERT INTO tt_players (username, score, wins, avatar_url) VALUES ({ph}, {ph}, {ph}, {ph}) "
+           "ON CONFLICT (username) DO UPDATE SET score = tt_players.score + excluded.score - 100, "
+           "wins = tt_players.wins + excluded.wins, "
+           "avatar_url = CASE WHEN excluded.avatar_url != '' THEN excluded.avatar_url ELSE tt_players.avatar_url END")
+    rows = [(u, 100 + d[0], d[1], d[2]) for u, d in deltas.items()]
+    with LEDGER_WRITE.time(), DB_LOCK, db_conn() as conn:
+        c = conn.cursor()
+        for i in range(0, len(rows), LEDGER_BATCH):
+            c.executemany(sql, rows[i:i+LEDGER_BATCH])
             conn.commit()
-            conn.close()
-        except Exception as e: print(f"Score Update Error: {e}")
 
-def get_score(username):
-    # Read-only doesn't strictly need lock, but good for consistency
+def flush_ledger():
+    with LEDGER_LOCK:
+        if not LEDGER["pending"] or LEDGER["inflight"]: return
+        LEDGER["inflight"], LEDGER["pending"] = LEDGER["pending"], {}
+        batch = LEDGER["inflight"]
     try:
-        conn = get_db()
-        c = conn.cursor()
-        ph = "?" if USE_SQLITE else "%s"
-        c.execute(f"SELECT score FROM tt_players WHERE username={ph}", (username,))
-        data = c.fetchone()
-        conn.close()
-        return data[0] if data else 0
-    except: return 0
+        write_deltas(batch)
+        ok = True
+    except Exception as e:
+        print(f"Score Update Error: {e}")
+        ok = False
+    with LEDGER_LOCK:
+        LEDGER["inflight"] = {}
+        if ok:
+            LEDGER["gen"] += 1
+            LEDGER_STATS["flushes"] += 1
+            LEDGER_STATS["rows"] += len(batch)
+        else:
+            # Fail hua toh deltas wapas pending me (agli baar phir try)
+            LEDGER_STATS["errors"] += 1
+            for u, d in batch.items():
+                p = LEDGER["pending"].setdefault(u, [0, 0, ""])
+                p[0] += d[0]; p[1] += d[1]; p[2] = p[2] or d[2]
+        LEDGER_LOCK.notify_all() # drain_ledger inflight khatam hone ka wait karta hai
+    return ok
+
+def drain_ledger(timeout=LEDGER_DRAIN_TIMEOUT):
+    # Exit pe (atexit): writer ka batch beech me ho toh flush_ledger seedha laut
+    # aata hai aur daemon writer exit pe mar jaata hai. Toh pehle us batch ka
+    # wait, phir jo pending bacha wo likho.
+    deadline = time.monotonic() + timeout
+    while True:
+        with LEDGER_LOCK:
+            while LEDGER["inflight"]:
+                left = deadline - time.monotonic()
+                if left <= 0: break
+                LEDGER_LOCK.wait(left)
+            if not LEDGER["pending"] and not LEDGER["inflight"]: return True
+        if time.monotonic() >= deadline:
+            print(f"Score Update Error: exit with {len(LEDGER['pending'])} users' scores unsaved")
+            return False
+        if flush_ledger() is False: time.sleep(min(0.5, max(0, deadline - time.monotonic())))
+
+def ledger_writer():
+    while True:
+        with LEDGER_LOCK:
+            while not LEDGER["pending"]: LEDGER_LOCK.wait()
+        time.sleep(LEDGER_FLUSH_INTERVAL) # burst ko ek batch me jama hone do
+        if not flush_ledger(): time.sleep(5)
+
+def sync_ledger(username, timeout=DB_POOL_TIMEOUT):
+    # Is user ke pending deltas abhi DB me (writer ka wait nahi). Bet wala game
+    # journal hone se pehle: crash ke baad restore refund karega, toh debit
+    # pakka DB me hona chahiye warna points hawa se bante hain.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with LEDGER_LOCK:
+            if username not in LEDGER["pending"] and username not in LEDGER["inflight"]: return True
+            busy = bool(LEDGER["inflight"])
+        if busy: time.sleep(0.005) # dusra flush chal raha hai
+        elif flush_ledger() is False: return False
+    return False
+
+def get_score(username, raw=False):
+    with SCORE_READ.time(): return read_score(username, raw)
+
+def read_score(username, raw=False):
+    # DB value + jo deltas abhi likhe nahi gaye. Beech me flush ho gaya (gen
+    # badla) toh dobara padho, warna delta do baar ya zero baar gin lenge.
+    # raw=True: row hi nahi hai toh None, read fail = ScoreReadError (balance cache ke liye).
+    for _ in range(3):
+        with LEDGER_LOCK:
+            gen = LEDGER["gen"]
+            delta, pending = pending_delta_unsafe(username)
+        try:
+            with db_conn() as conn:
+                c = conn.cursor()
+                ph = "?" if USE_SQLITE else "%s"
+                c.execute(f"SELECT score FROM tt_players WHERE username={ph}", (username,))
+                data = c.fetchone()
+        except Exception as e:
+            if raw: raise ScoreReadError(e)
+            return 0
+        with LEDGER_LOCK:
+            if LEDGER["gen"] != gen: continue
+        if data: return data[0] + delta
+        if pending: return 100 + delta
+        return None if raw else 0
+    if raw: raise ScoreReadError("ledger kept flushing during read")
+    return 0
 
 def get_leaderboard_data():
     try:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT username, score, wins, avatar_url FROM tt_players ORDER BY score DESC LIMIT 50")
-        data = c.fetchall()
-        conn.close()
-        return data
+        with db_conn() as conn:
+            c = conn.cursor()
+            c.execute("SELECT username, score, wins, avatar_url FROM tt_players ORDER BY score DESC LIMIT 50")
+            return c.fetchall()
     except: return []
 
+# --- LEADERBOARD (MATERIALIZED) ---
+# Saare players ek baar startup pe memory me, phir har update_score() pe
+# sorted list incrementally update. Top-N badla tabhi cached HTML/JSON hatao.
+# !rank = ek bisect, table scan nahi.
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", 50))
+RANK_USERS = {} # user -> (score, wins, avatar)
+RANK_ORDER = [] # sorted (-score, user)
+RANK_LOCK = threading.Lock()
+RANKING = {"loaded": False, "version": 0, "html": None, "json": None}
+
+def load_rankings():
+    try:
+        with db_conn() as conn:
+            c = conn.cursor()
+            c.execute("SELECT username, score, wins, avatar_url FROM tt_players")
+            rows = c.fetchall()
+    except Exception as e:
+        print("Rank Load Error:", e)
+        return
+    with RANK_LOCK:
+        RANK_USERS.clear()
+        RANK_USERS.update({u: (sc or 0, w or 0, av or "") for u, sc, w, av in rows})
+        RANK_ORDER[:] = sorted((-v[0], u) for u, v in RANK_USERS.items())
+        RANKING.update(loaded=True, version=RANKING["version"] + 1, html=None, json=None)
+
+def rank_apply(username, points, avatar_url=""):
+    # update_score() jaisa hi hisaab: naya user = 100 bonus, +points = ek win
+    with RANK_LOCK:
+        old = RANK_USERS.get(username)
+        score, wins, av = old or (100, 0, "")
+        old_pos = LEADERBOARD_SIZE
+        if old:
+            old_pos = bisect.bisect_left(RANK_ORDER, (-score, username))
+            del RANK_ORDER[old_pos]
+        new = (score + points, wins + (1 if points > 0 else 0), avatar_url or av)
+        RANK_USERS[username] = new
+        new_pos = bisect.bisect_left(RANK_ORDER, (-new[0], username))
+        RANK_ORDER.insert(new_pos, (-new[0], username))
+        if min(old_pos, new_pos) < LEADERBOARD_SIZE:
+            RANKING.update(version=RANKING["version"] + 1, html=None, json=None)
+
+def get_rank(username):
+    # (rank, score) - same score wale same rank share karte hain
+    with RANK_LOCK:
+        v = RANK_USERS.get(username)
+        if not v: return None, 0
+        return bisect.bisect_left(RANK_ORDER, (-v[0], "")) + 1, v[0]
+
+def top_players():
+    with RANK_LOCK:
+        if not RANKING["loaded"]: return None
+        return [(u, -neg, RANK_USERS[u][1], RANK_USERS[u][2]) for neg, u in RANK_ORDER[:LEADERBOARD_SIZE]]
+
 init_db()
+load_rankings()
+threading.Thread(target=ledger_writer, daemon=True).start()
+atexit.register(drain_ledger)
 
 # =============================================================================
-# 4. BOT CORE & RECONNECT LOGIC
+# 4. BOT CORE & RECONNECT LOGIC (ASYNCIO)
 # =============================================================================
-BOT = {
-    "ws": None, "status": "DISCONNECTED",
-    "user": "", "pass": "", "room": "", "domain": "",
-    "should_run": False, "avatars": {}
-}
-
-CHAT_HISTORY = []
-DEBUG_LOGS = []
+# Ek event loop thread saare rooms ke connections, keepalive, outbound sends,
+# idle checks aur delayed bot moves chalata hai. Game logic (GAME_LOCK, DB,
+# balance) blocking hai, isliye wo ek single-thread executor pe chalta hai,
+# jo har room ke messages ka order bhi bana ke rakhta hai.
+# Reconnects ya games kitne bhi hon, thread count same rehta hai.
+ENGINE = {"loop": None, "thread": None}
+ENGINE_LOCK = threading.Lock()
+# Game kaam ek pool pe. key wale tasks us key ke mailbox me: ek key ke tasks
+# strictly order me (ek time pe ek hi worker), alag keys parallel. Game state
+# ki safety per-game lock se, mailbox sirf ordering ke liye.
+GAME_WORKERS = int(os.environ.get("GAME_WORKERS", 4))
+
+class GameActors:
+    def __init__(self, workers, batch=32):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="game")
+        self.boxes = {} # key -> deque of (fn, args)
+        self.lock = threading.Lock()
+        self.batch = batch # itne ke baad worker chhodo, doosre mailboxes ko bhi mauka
+
+    def submit(self, fn, *args, key=None):
+        if key is None: return self.pool.submit(self._run, fn, args)
+        with self.lock:
+            box = self.boxes.get(key)
+            if box is not None:
+                box.append((fn, args))
+                return
+            self.boxes[key] = deque([(fn, args)])
+        self.pool.submit(self._drain, key)
+
+    def _run(self, fn, args):
+        try: fn(*args)
+        except Exception as e: save_debug("ERROR", f"{getattr(fn, '__name__', fn)}: {e}")
+
+    def _drain(self, key):
+        for _ in range(self.batch):
+            with self.lock:
+                box = self.boxes[key]
+                if not box:
+                    del self.boxes[key]
+                    return
+                fn, args = box.popleft()
+            self._run(fn, args)
+        self.pool.submit(self._drain, key)
+
+    def pending(self):
+        with self.lock: return sum(len(b) for b in self.boxes.values())
+
+GAME_EXECUTOR = GameActors(GAME_WORKERS)
+# Chat server endpoint; load test ke liye local stand-in (fake_chat_server.py)
+CHAT_URL = os.environ.get("CHAT_URL", "wss://chatp.net:5333/server")
+WS_SSL = ssl.create_default_context()
+WS_SSL.check_hostname = False
+WS_SSL.verify_mode = ssl.CERT_NONE
+
+# --- TIMER WHEEL ---
+# Game timeouts aur bot move delays dono ek hi hierarchical wheel pe. Level 0:
+# TICK sec ke slots, level 1: ek poora level-0 chakkar per slot, usse lamba =
+# overflow. Arm/cancel O(1), har tick pe sirf ek slot dekhna padta hai (scan nahi).
+# Cancel lazy hai: entry slot me padi rehti hai, fire hone pe skip.
+class TimerWheel:
+    def __init__(self, tick=0.1, slots0=600, slots1=60, clock=time.monotonic):
+        self.tick, self.s0, self.s1 = tick, slots0, slots1
+        self.level0 = [[] for _ in range(slots0)]
+        self.level1 = [[] for _ in range(slots1)]
+        self.overflow = []
+        self.clock = clock # replay virtual clock de sakta hai
+        self.origin = clock()
+        self.ticks = 0
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def _place(self, entry):
+        due = entry[0]
+        diff = due - self.ticks
+        if diff < self.s0: self.level0[due % self.s0].append(entry)
+        elif diff < self.s0 * self.s1: self.level1[(due // self.s0) % self.s1].append(entry)
+        else: self.overflow.append(entry)
+
+    def schedule(self, delay, fn, *args):
+        # Returns handle; cancel(handle) se rok sakte ho
+        with self.lock:
+            due = max(int((self.clock() - self.origin + delay) / self.tick + 0.999), self.ticks + 1)
+            entry = [due, fn, args, False]
+            self._place(entry)
+            self.pending += 1
+        return entry
+
+    def armed(self, entry):
+        # Abhi na fire hua na cancel
+        return bool(entry) and not entry[3]
+
+    def cancel(self, entry):
+        if entry and not entry[3]:
+            with self.lock:
+                if not entry[3]: entry[3] = True; self.pending -= 1
+
+    def advance(self, now=None):
+        # now tak ke saare expired callbacks return karta hai (call caller kare)
+        now = self.clock() if now is None else now
+        target = int((now - self.origin) / self.tick)
+        fired = []
+        with self.lock:
+            while self.ticks < target:
+                self.ticks += 1
+                if self.ticks % self.s0 == 0:
+                    # Level 1 ka agla slot neeche utaro
+                    idx = (self.ticks // self.s0) % self.s1
+                    cascade, self.level1[idx] = self.level1[idx], []
+                    if idx == 0: cascade, self.overflow = cascade + self.overflow, []
+                    for entry in cascade: self._place(entry)
+                slot = self.level0[self.ticks % self.s0]
+                if not slot: continue
+                keep = []
+                for entry in slot:
+                    if entry[3]: continue
+                    if entry[0] <= self.ticks:
+                        entry[3] = True
+                        self.pending -= 1
+                        fired.append(entry)
+                    else: keep.append(entry)
+                self.level0[self.ticks % self.s0] = keep
+        return fired
+
+WHEEL = TimerWheel(float(os.environ.get("TIMER_TICK", 0.1)))
+
+async def wheel_driver():
+    while True:
+        await asyncio.sleep(WHEEL.tick)
+        for _, fn, args, _ in WHEEL.advance():
+            GAME_EXECUTOR.submit(fn, *args)
+
+def schedule(delay, fn, *args):
+    # delay sec baad fn(*args) game executor pe (threading.Timer ka replacement)
+    return WHEEL.schedule(delay, fn, *args)
+
+def start_engine():
+    with ENGINE_LOCK:
+        if ENGINE["loop"]: return ENGINE["loop"]
+        ready = threading.Event()
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            ENGINE["loop"] = loop
+            loop.create_task(wheel_driver())
+            ready.set()
+            loop.run_forever()
+        ENGINE["thread"] = threading.Thread(target=run, name="engine", daemon=True)
+        ENGINE["thread"].start()
+        ready.wait()
+        return ENGINE["loop"]
+
+# Ek process, kai rooms. Har room ka apna connection, credentials, chat
+# history aur outbox; games (room, host) key se partitioned hain.
+ROOMS = {} # room.lower() -> room state
+ROOMS_LOCK = threading.Lock()
+CHAT_HISTORY_SIZE = int(os.environ.get("CHAT_HISTORY_SIZE", 100))
+
+# --- OUTBOX ---
+# Har room ki ek outbound queue, ek writer task. Rate = token bucket (msgs/sec),
+# same game ka purana board image abhi queue me hai toh naya usi ki jagah le
+# leta hai (sirf latest state bhejna zaroori). Queue full ho toh send_msg
+# caller (game executor) OUTBOX_BLOCK sec tak rukta hai, phir drop.
+OUTBOX_SIZE = int(os.environ.get("OUTBOX_SIZE", 200))
+OUTBOX_RATE = float(os.environ.get("OUTBOX_RATE", 5)) # msgs/sec per room
+OUTBOX_BURST = int(os.environ.get("OUTBOX_BURST", 5))
+OUTBOX_BLOCK = float(os.environ.get("OUTBOX_BLOCK", 2.0))
+
+SEND_LATENCY = Histogram("tt_send_latency_seconds", "send_msg() enqueue to websocket send")
+
+class Outbox:
+    def __init__(self, maxlen, rate, burst):
+        self.items = deque() # [enqueued_at, pkt, coalesce_key]; pkt None = coalesce me hata (lazy)
+        self.dead = 0
+        self.by_key = {}
+        self.cond = threading.Condition()
+        self.maxlen, self.rate, self.burst = maxlen, rate, burst
+        self.tokens, self.refilled = float(burst), time.monotonic()
+        self.event = asyncio.Event()
+        self.stats = {"queued": 0, "sent": 0, "coalesced": 0, "dropped": 0, "blocked": 0, "latency_sum": 0.0, "latency_max": 0.0}
+
+    def __len__(self): return len(self.items) - self.dead
+
+    def put(self, pkt, key=None, block=True):
+        with self.cond:
+            entry = self.by_key.pop(key, None) if key is not None else None
+            if entry:
+                # Purana packet mark dead (O(1), pop skip karega), naya peeche: baad me
+                # queue hue texts se aage na jaaye. Dead zyada ho gaye toh compact.
+                entry[1] = None
+                self.dead += 1
+                if self.dead > len(self.items) // 2:
+                    self.items = deque(e for e in self.items if e[1] is not None)
+                    self.dead = 0
+                entry = [time.monotonic(), pkt, key]
+                self.items.append(entry)
+                self.by_key[key] = entry
+                self.stats["coalesced"] += 1
+                return True
+            if len(self) >= self.maxlen:
+                self.stats["blocked"] += 1
+                if not block or not self.cond.wait_for(lambda: len(self) < self.maxlen, OUTBOX_BLOCK):
+                    self.stats["dropped"] += 1
+                    return False
+            entry = [time.monotonic(), pkt, key]
+            self.items.append(entry)
+            if key is not None: self.by_key[key] = entry
+            self.stats["queued"] += 1
+        loop = ENGINE["loop"]
+        if loop: loop.call_soon_threadsafe(self.event.set)
+        return True
 
-def save_chat(user, msg, avatar="", type="text"):
-    timestamp = time.strftime("%H:%M")
-    CHAT_HISTORY.append({"user": user, "msg": msg, "avatar": avatar, "time": timestamp, "type": type})
-    if len(CHAT_HISTORY) > 100: CHAT_HISTORY.pop(0)
+    def pop(self):
+        with self.cond:
+            while self.items and self.items[0][1] is None:
+                self.items.popleft()
+                self.dead -= 1
+            if not self.items: return None
+            entry = self.items.popleft()
+            if entry[2] is not None: self.by_key.pop(entry[2], None)
+            self.cond.notify()
+            return entry
+
+    def requeue(self, entry):
+        # Send fail hua: wapas aage, reconnect ke baad pehle yahi jayega
+        with self.cond:
+            self.items.appendleft(entry)
+            if entry[2] is not None: self.by_key.setdefault(entry[2], entry)
+
+    def take_token(self):
+        # 0 = token mila, warna kitna rukna hai
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def sent(self, entry):
+        latency = time.monotonic() - entry[0]
+        SEND_LATENCY.observe(latency)
+        with self.cond:
+            self.stats["sent"] += 1
+            self.stats["latency_sum"] += latency
+            self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+
+    def snapshot(self):
+        with self.cond:
+            stats = dict(self.stats, depth=len(self), capacity=self.maxlen, rate=self.rate)
+        stats["latency_avg_ms"] = round(stats.pop("latency_sum") / stats["sent"] * 1000, 1) if stats["sent"] else 0
+        stats["latency_max_ms"] = round(stats.pop("latency_max") * 1000, 1)
+        return stats
+
+def new_room(user, password, room, domain, url=CHAT_URL):
+    return {
+        "ws": None, "status": "DISCONNECTED", "key": room.lower(), "url": url,
+        "user": user, "pass": password, "room": room, "domain": domain,
+        "should_run": True, "avatars": {}, "chat": RingLog(CHAT_HISTORY_SIZE),
+        "outbox": Outbox(OUTBOX_SIZE, OUTBOX_RATE, OUTBOX_BURST), "task": None,
+        "writer": None, "wake": asyncio.Event(), "auth_failed": False,
+        "conn": {"reconnects": 0, "transport_failures": 0, "auth_failures": 0, "dropped_sends": 0,
+                 "attempt_at": 0.0, "online_at": 0.0, "down_since": None, "next_retry_at": None,
+                 "time_to_online_ms": None, "last_outage_s": None}
+    }
+
+def default_room():
+    # Dashboard ne room nahi bataya toh pehla connected room
+    return next(iter(ROOMS.values()), None)
+
+# --- LOG STORES (RING BUFFERS) ---
+# Fixed-capacity ring: trim O(1) (list.pop(0) O(n) tha). Raw tuple store
+# hota hai; dict banana / JSON decode sirf tab jab dashboard padhe.
+class RingLog:
+    __slots__ = ("buf", "start", "count")
+
+    def __init__(self, capacity):
+        self.buf = [None] * capacity
+        self.start = self.count = 0
+
+    def __len__(self): return self.count
+
+    def append(self, item):
+        cap = len(self.buf)
+        if self.count < cap:
+            self.buf[(self.start + self.count) % cap] = item
+            self.count += 1
+        else:
+            self.buf[self.start] = item
+            self.start = (self.start + 1) % cap
+
+    def clear(self):
+        self.buf = [None] * len(self.buf)
+        self.start = self.count = 0
+
+    def since(self, seq):
+        # item[0] = seq (badhta hua), binary search pehla naya item
+        cap, lo, hi = len(self.buf), 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.buf[(self.start + mid) % cap][0] > seq: hi = mid
+            else: lo = mid + 1
+        return [self.buf[(self.start + i) % cap] for i in range(lo, self.count)]
+
+DEBUG_LOGS = RingLog(int(os.environ.get("DEBUG_LOG_SIZE", 200)))
+# Har chat/debug entry ko ek badhta hua "id" milta hai (dono ka ek hi counter).
+# Dashboard `since=` cursor bhejta hai aur sirf naye entries leta hai.
+# "cleared" = last /clear_data ka seq; us se purana cursor = full reload.
+LOG_SEQ = {"seq": 0, "cleared": 0}
+LOG_COND = threading.Condition()
+BOOT_ID = "%x" % int(time.time() * 1000) # ETag me, taaki dusre worker ka seq match na ho
+
+# Debug capture: "all" | "sample" (har Nth packet) | "off". "all" me bhi
+# DEBUG_MAX_RATE/sec se zyada aaye toh us second ke liye sampling. Errors hamesha.
+DEBUG_CAPTURE = {"mode": os.environ.get("DEBUG_CAPTURE", "all"),
+                 "sample": int(os.environ.get("DEBUG_SAMPLE", 10)),
+                 "max_rate": int(os.environ.get("DEBUG_MAX_RATE", 50)),
+                 "second": 0, "count": 0, "skipped": 0}
+
+def save_chat(bot, user, msg, avatar="", type="text"):
+    with LOG_COND:
+        LOG_SEQ["seq"] += 1
+        item = (LOG_SEQ["seq"], time.time(), user, msg, avatar, type)
+        bot["chat"].append(item)
+        LOG_COND.notify_all()
+    if CLUSTER["leader"]: CHAT_QUEUE.put((bot["key"],) + item[1:]) # baaki workers ke dashboard ke liye
+
+def debug_should_capture(direction):
+    cfg = DEBUG_CAPTURE
+    if "ERROR" in direction: return True
+    if cfg["mode"] == "off": return False
+    now = int(time.time())
+    if now != cfg["second"]: cfg["second"], cfg["count"] = now, 0
+    cfg["count"] += 1
+    if cfg["mode"] == "sample" or (cfg["max_rate"] and cfg["count"] > cfg["max_rate"]):
+        if cfg["count"] % max(cfg["sample"], 1):
+            cfg["skipped"] += 1
+            return False
+    return True
+
+DEBUG_REDACT = ("password",)
+
+def redact(payload):
+    # Login packet ka password ring/files/(debug/search) me kabhi nahi
+    if isinstance(payload, dict) and any(k in payload for k in DEBUG_REDACT):
+        return {k: "***" if k in DEBUG_REDACT else v for k, v in payload.items()}
+    return payload
 
 def save_debug(direction, payload):
-    timestamp = time.strftime("%H:%M:%S")
-    try:
-        if isinstance(payload, str): payload = json.loads(payload)
-    except: pass
-    DEBUG_LOGS.append({"time": timestamp, "dir": direction, "data": payload})
-    if len(DEBUG_LOGS) > 200: DEBUG_LOGS.pop(0)
+    # Payload jaisa aaya waisa hi (str ya dict) - decode read pe hoga
+    ts = time.time()
+    with LOG_COND:
+        if not debug_should_capture(direction): return
+        payload = redact(payload)
+        LOG_SEQ["seq"] += 1
+        DEBUG_LOGS.append((LOG_SEQ["seq"], ts, direction, payload))
+        LOG_COND.notify_all()
+    persist_debug(ts, direction, payload)
+
+# --- DEBUG LOG FILES (JSONL, ROTATING) ---
+# Memory ke 200 packets seconds me gayab ho jaate hain. Har captured packet
+# ek bounded queue se background writer tak jaata hai jo size-rotated JSONL
+# files likhta hai. Queue full = packet drop (counter), bot kabhi nahi rukta.
+# Har file ke saath "<file>.idx" = {minute: pehli line ka byte offset}, search
+# seedha us offset pe seek karta hai.
+DEBUG_LOG_DIR = os.environ.get("DEBUG_LOG_DIR", "debug_logs") # "" = band
+DEBUG_FILE_MAX = int(os.environ.get("DEBUG_FILE_MAX", 10 * 1024 * 1024)) # bytes per file
+DEBUG_FILE_KEEP = int(os.environ.get("DEBUG_FILE_KEEP", 20))
+DEBUG_QUEUE = queue.Queue(maxsize=int(os.environ.get("DEBUG_QUEUE_MAX", 10000)))
+DEBUG_FILE_STATS = {"written": 0, "dropped": 0, "rotations": 0, "errors": 0}
+DEBUG_FILE = {"path": None, "f": None, "size": 0, "index": {}, "n": 0}
+
+def persist_debug(ts, direction, payload):
+    if not DEBUG_LOG_DIR: return
+    try: DEBUG_QUEUE.put_nowait((ts, direction, payload))
+    except queue.Full: DEBUG_FILE_STATS["dropped"] += 1
+
+def _save_debug_index():
+    with open(DEBUG_FILE["path"] + ".idx", "w") as f: json.dump(DEBUG_FILE["index"], f)
+
+def _rotate_debug_file():
+    if DEBUG_FILE["f"]:
+        DEBUG_FILE["f"].close()
+        _save_debug_index()
+        DEBUG_FILE_STATS["rotations"] += 1
+    os.makedirs(DEBUG_LOG_DIR, exist_ok=True)
+    # pid naam me: kai gunicorn workers ek hi dir me likh sakte hain
+    DEBUG_FILE["n"] += 1
+    path = os.path.join(DEBUG_LOG_DIR, time.strftime("debug-%Y%m%d-%H%M%S") + f"-{os.getpid()}-{DEBUG_FILE['n']}.jsonl")
+    DEBUG_FILE.update(path=path, f=open(path, "a", encoding="utf-8"), size=0, index={})
+    old = sorted(glob.glob(os.path.join(DEBUG_LOG_DIR, "debug-*.jsonl")), key=os.path.getmtime)
+    for stale in old[:-DEBUG_FILE_KEEP]:
+        for p in (stale, stale + ".idx"):
+            try: os.remove(p)
+            except OSError: pass
+
+def debug_file_writer():
+    while True:
+        item = DEBUG_QUEUE.get()
+        try:
+            if DEBUG_FILE["f"] is None or DEBUG_FILE["size"] >= DEBUG_FILE_MAX: _rotate_debug_file()
+            ts, direction, payload = item
+            if isinstance(payload, str):
+                try: payload = json.loads(payload)
+                except: pass
+            handler = payload.get("handler", "") if isinstance(payload, dict) else ""
+            line = json.dumps({"ts": round(ts, 3), "dir": direction, "handler": handler, "data": payload}, default=str) + "\n"
+            minute = str(int(ts // 60))
+            if minute not in DEBUG_FILE["index"]:
+                DEBUG_FILE["index"][minute] = DEBUG_FILE["size"]
+                _save_debug_index()
+            data = line.encode("utf-8")
+            DEBUG_FILE["f"].write(line)
+            DEBUG_FILE["size"] += len(data)
+            DEBUG_FILE_STATS["written"] += 1
+            if DEBUG_QUEUE.empty(): DEBUG_FILE["f"].flush()
+        except Exception as e:
+            DEBUG_FILE_STATS["errors"] += 1
+            print("Debug Log Error:", e)
 
-def bot_thread():
+def search_debug_files(t_from, t_to, direction=None, handler=None, limit=500):
+    results = []
+    if DEBUG_FILE["f"]: DEBUG_FILE["f"].flush()
+    for path in sorted(glob.glob(os.path.join(DEBUG_LOG_DIR, "debug-*.jsonl")), key=os.path.getmtime):
+        try:
+            with open(path + ".idx") as f: index = {int(k): v for k, v in json.load(f).items()}
+        except (OSError, ValueError): index = {}
+        if index:
+            # File ka time range index se pata hai, overlap nahi toh file khologe bhi nahi
+            if max(index) * 60 + 60 < t_from and os.path.getmtime(path) < t_from: continue
+            if min(index) * 60 > t_to: continue
+        start_min = int(t_from // 60)
+        offsets = [off for m, off in index.items() if m <= start_min]
+        offset = max(offsets) if offsets else 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for raw in f:
+                try: entry = json.loads(raw)
+                except ValueError: continue
+                if entry["ts"] < t_from: continue
+                if entry["ts"] > t_to: break
+                if direction and entry["dir"] != direction: continue
+                if handler and entry.get("handler") != handler: continue
+                results.append(entry)
+                if len(results) >= limit: return results
+    return results
+
+if DEBUG_LOG_DIR: threading.Thread(target=debug_file_writer, daemon=True).start()
+
+def format_chat(item):
+    seq, ts, user, msg, avatar, type = item
+    return {"id": seq, "user": user, "msg": msg, "avatar": avatar, "time": time.strftime("%H:%M", time.localtime(ts)), "type": type}
+
+def format_debug(item):
+    seq, ts, direction, payload = item
+    if isinstance(payload, str):
+        try: payload = json.loads(payload)
+        except: pass
+    return {"id": seq, "time": time.strftime("%H:%M:%S", time.localtime(ts)), "dir": direction, "data": payload}
+
+def log_snapshot(bot, since=None):
+    with LOG_COND:
+        seq = LOG_SEQ["seq"]
+        reset = since is None or since < LOG_SEQ["cleared"] or since > seq
+        chat = bot["chat"].since(-1 if reset else since) if bot else []
+        debug = DEBUG_LOGS.since(-1 if reset else since)
+    # Formatting lock ke bahar
+    return {"seq": seq, "reset": reset, "chat": [format_chat(i) for i in chat], "debug": [format_debug(i) for i in debug]}
+
+# --- TRAFFIC RECORDER ---
+# Ek room ka inbound (room_event/login_event) raw + timing, aur jo bot ne bheja,
+# JSONL me. replay.py isse on_message() me wapas daal ke outbound match karta hai.
+RECORD_DIR = os.environ.get("RECORD_DIR", "recordings")
+RECORD = {"f": None, "room": None, "path": None, "t0": 0.0, "count": 0}
+RECORD_LOCK = threading.Lock()
+
+def recording_config():
+    # Jo settings outbound packets/timing badalti hain: replay.py inhe wapas laga deta hai
+    return {"bot_move_delay": BOT_MOVE_DELAY, "timeouts": dict(GAME_TIMEOUTS), "bot_level": BOT_DEFAULT_LEVEL,
+            "timer_tick": WHEEL.tick, "board_url_params": BOARD_URL_PARAMS, "bot_nodes": BOT_NODES,
+            "bot_think_ms": BOT_THINK_MS, "bot_max_depth": BOT_MAX_DEPTH, "bot_branch": BOT_BRANCH}
+
+def start_recording(bot, path=None):
+    with RECORD_LOCK:
+        if RECORD["f"]: RECORD["f"].close()
+        if not path:
+            os.makedirs(RECORD_DIR, exist_ok=True)
+            path = os.path.join(RECORD_DIR, f"rec-{bot['key']}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+        seed = random.randrange(2**32)
+        BOT_RNG.seed(seed)
+        f = open(path, "w", encoding="utf-8")
+        f.write(json.dumps({"v": 2, "room": bot["room"], "user": bot["user"], "domain": bot["domain"], "seed": seed,
+                            "started": time.time(), "config": recording_config()}) + "\n")
+        RECORD.update(f=f, room=bot["key"], path=path, t0=time.monotonic(), count=0)
+    return path
+
+def stop_recording():
+    with RECORD_LOCK:
+        if RECORD["f"]: RECORD["f"].close()
+        info = {"path": RECORD["path"], "records": RECORD["count"]}
+        RECORD.update(f=None, room=None)
+    return info
+
+def record(bot, direction, item):
+    if RECORD["room"] != bot["key"]: return
+    with RECORD_LOCK:
+        if not RECORD["f"]: return
+        RECORD["f"].write(json.dumps({"t": round(time.monotonic() - RECORD["t0"], 4), "dir": direction, "data": item}) + "\n")
+        RECORD["count"] += 1
+
+# --- RECONNECT ---
+# Exponential backoff + jitter (server blip ke baad saare instances ek saath
+# na aayein). Auth fail alag: lambi backoff, AUTH_MAX_FAILS ke baad band.
+RECONNECT_BASE = float(os.environ.get("RECONNECT_BASE", 1.0))
+RECONNECT_MAX = float(os.environ.get("RECONNECT_MAX", 60))
+AUTH_RETRY_BASE = float(os.environ.get("AUTH_RETRY_BASE", 60))
+AUTH_RETRY_MAX = float(os.environ.get("AUTH_RETRY_MAX", 1800))
+AUTH_MAX_FAILS = int(os.environ.get("AUTH_MAX_FAILS", 3))
+
+def backoff_delay(attempt, base, cap):
+    # Equal jitter: aadha fixed, aadha random
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+async def bot_session(bot):
     # AUTO-RECONNECT LOOP
-    while BOT["should_run"]:
+    conn = bot["conn"]
+    fails = auth_fails = 0
+    bot["wake"].clear()
+    while bot["should_run"]:
+        bot["status"], bot["auth_failed"] = "CONNECTING", False
+        conn["attempt_at"] = time.monotonic()
         try:
-            BOT["status"] = "CONNECTING"
-            ws = websocket.WebSocketApp(
-                "wss://chatp.net:5333/server",
-                on_open=on_open,
-                on_message=on_message,
-                on_error=on_error,
-                on_close=on_close
-            )
-            BOT["ws"] = ws
-            ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
+            url = bot["url"]
+            async with ws_connect(url, ssl=WS_SSL if url.startswith("wss:") else None, ping_interval=None) as ws:
+                bot["ws"] = ws
+                await on_open(bot, ws)
+                ping = asyncio.create_task(pinger(ws))
+                try:
+                    async for message in ws: await on_message(bot, ws, message)
+                finally:
+                    bot["ws"] = None
+                    ping.cancel()
+                    if bot["writer"]: bot["writer"].cancel()
         except Exception as e:
-            save_debug("ERROR", f"Connection Crash: {str(e)}")
+            save_debug("ERROR", f"[{bot['room']}] Connection Crash: {str(e)}")
+        was_online = conn["online_at"] > conn["attempt_at"]
+        if was_online: conn["down_since"] = time.monotonic()
+        on_close(bot)
+        if not bot["should_run"]: break
         
-        # Agar connection tuta (Kick hua ya Net gaya), 5 sec wait karke wapas chalega
-        if BOT["should_run"]:
-            BOT["status"] = "RETRYING (5s)..."
-            time.sleep(5)
-
-def on_open(ws):
-    BOT["status"] = "AUTHENTICATING"
-    pkt = {"handler": "login", "id": str(time.time()), "username": BOT["user"], "password": BOT["pass"], "platform": "web"}
-    ws.send(json.dumps(pkt))
+        if bot["auth_failed"]:
+            conn["auth_failures"] += 1
+            auth_fails += 1
+            if auth_fails >= AUTH_MAX_FAILS:
+                bot["status"], bot["should_run"] = "LOGIN FAILED", False
+                break
+            delay = backoff_delay(auth_fails - 1, AUTH_RETRY_BASE, AUTH_RETRY_MAX)
+        else:
+            conn["transport_failures"] += 1
+            if was_online: fails = auth_fails = 0
+            delay = backoff_delay(fails, RECONNECT_BASE, RECONNECT_MAX)
+            fails += 1
+        
+        # Connection tuta (Kick hua ya Net gaya): backoff ke baad wapas. /connect ya /disconnect jaldi jaga deta hai
+        bot["status"] = f"RETRYING ({delay:.1f}s)..."
+        conn["next_retry_at"] = time.time() + delay
+        try: await asyncio.wait_for(bot["wake"].wait(), delay)
+        except asyncio.TimeoutError: pass
+        bot["wake"].clear()
+        conn["next_retry_at"] = None
+        if bot["should_run"]: conn["reconnects"] += 1
+
+async def on_open(bot, ws):
+    bot["status"] = "AUTHENTICATING"
+    pkt = {"handler": "login", "id": str(time.time()), "username": bot["user"], "password": bot["pass"], "platform": "web"}
+    await ws.send(json.dumps(pkt))
     save_debug("OUT", pkt)
-    
-    # Background Tasks
-    threading.Thread(target=pinger, daemon=True).start()
-    threading.Thread(target=idle_game_checker, daemon=True).start()
 
-def pinger():
-    while BOT["ws"] and BOT["ws"].sock and BOT["ws"].sock.connected:
-        time.sleep(20)
-        try: BOT["ws"].send(json.dumps({"handler": "ping"}))
-        except: break
+async def pinger(ws):
+    while True:
+        await asyncio.sleep(20)
+        await ws.send(json.dumps({"handler": "ping"}))
+
+ON_MESSAGE = Histogram("tt_on_message_seconds", "Inbound packet handling time on the event loop")
+COMMAND_SECONDS = Histogram("tt_command_seconds", "game_engine() time per command", ("command",))
+PACKETS = Counter("tt_inbound_packets_total", "Inbound packets by handler", ("handler",))
+COMMANDS = ("!help", "!rank", "!score", "!start", "!join", "!stop")
+
+def handle_message(bot, user, msg):
+    # game_engine + timing; label fixed set se (user text label nahi banta)
+    tok = msg.strip().lower().split(" ", 1)[0]
+    cmd = tok[1:] if tok in COMMANDS else "move" if tok.isdigit() else "other"
+    with COMMAND_SECONDS.time(cmd): game_engine(bot, user, msg)
 
-def on_message(ws, message):
+def dispatch_message(bot, user, body):
+    # Har user ka apna mailbox: uske messages order me, baaki users/games parallel
+    GAME_EXECUTOR.submit(handle_message, bot, user, body, key=(bot["key"], user))
+
+async def on_message(bot, ws, message):
+    with ON_MESSAGE.time(): await handle_packet(bot, ws, message)
+
+async def handle_packet(bot, ws, message):
     try:
         data = json.loads(message)
+        PACKETS.inc(str(data.get("handler")))
+        if RECORD["room"] and data.get("handler") in ("room_event", "login_event"): record(bot, "in", message)
         
         # Cache Avatar
         if data.get("avatar_url") and data.get("from"): 
-            BOT["avatars"][data["from"]] = data["avatar_url"]
+            bot["avatars"][data["from"]] = data["avatar_url"]
 
         if data.get("handler") not in ["receipt_ack", "ping"]: 
             save_debug("IN", data)
 
         if data.get("handler") == "login_event":
             if data["type"] == "success":
-                BOT["status"] = "ONLINE"
-                pkt = {"handler": "room_join", "id": str(time.time()), "name": BOT["room"]}
-                ws.send(json.dumps(pkt))
+                bot["status"] = "ONLINE"
+                conn = bot["conn"]
+                conn["online_at"] = now = time.monotonic()
+                conn["time_to_online_ms"] = round((now - conn["attempt_at"]) * 1000, 1)
+                if conn["down_since"]:
+                    conn["last_outage_s"], conn["down_since"] = round(now - conn["down_since"], 1), None
+                pkt = {"handler": "room_join", "id": str(time.time()), "name": bot["room"]}
+                await ws.send(json.dumps(pkt))
                 save_debug("OUT", pkt)
+                # Writer join ke baad: disconnect ke dauran queue hue messages ab jayenge
+                bot["writer"] = asyncio.create_task(outbound_writer(bot, ws))
+                GAME_EXECUTOR.submit(resume_games, bot)
             else:
-                BOT["status"] = "LOGIN FAILED"
-                BOT["should_run"] = False
-                ws.close()
+                bot["status"] = "AUTH FAILED"
+                bot["auth_failed"] = True
+                await ws.close()
                 
         elif data.get("handler") == "room_event" and data.get("type") == "text":
-            av = BOT["avatars"].get(data['from'], "https://cdn-icons-png.flaticon.com/512/149/149071.png")
-            save_chat(data['from'], data['body'], av, "text")
+            av = bot["avatars"].get(data['from'], "https://cdn-icons-png.flaticon.com/512/149/149071.png")
+            save_chat(bot, data['from'], data['body'], av, "text")
             
-            # Game Logic Call
-            game_engine(data['from'], data['body'])
+            # Game Logic Call (blocking kaam loop ke bahar)
+            dispatch_message(bot, data['from'], data['body'])
             
     except Exception as e: save_debug("ERROR", str(e))
 
-def on_error(ws, error): save_debug("WS ERROR", str(error))
-def on_close(ws, c, m): BOT["status"] = "DISCONNECTED"
-
-def send_msg(text, type="text", url=""):
-    if BOT["ws"]:
-        pkt = {"handler": "room_message", "id": str(time.time()), "room": BOT["room"], "type": type, "body": text, "url": url, "length": "0"}
+def on_close(bot):
+    if bot["status"] != "LOGIN FAILED": bot["status"] = "DISCONNECTED"
+
+async def outbound_writer(bot, ws):
+    # Saare sends isi ek task se: kisi bhi thread se send_msg() safe hai
+    box = bot["outbox"]
+    while True:
+        if not len(box):
+            box.event.clear()
+            if not len(box): await box.event.wait()
+            continue
+        # Token ka wait pop se pehle: rukte waqt board aur coalesce ho sakta hai
+        wait = box.take_token()
+        if wait:
+            await asyncio.sleep(wait)
+            continue
+        entry = box.pop()
+        if not entry: continue
+        pkt = entry[1]
         try:
-            BOT["ws"].send(json.dumps(pkt))
-            bot_av = "https://cdn-icons-png.flaticon.com/512/4712/4712035.png"
-            display = "[IMAGE SENT]" if type == "image" else text
-            save_chat("TitanBot", display, bot_av, "bot")
-            save_debug("OUT", pkt)
-        except: pass
+            await ws.send(json.dumps(pkt))
+        except Exception as e:
+            box.requeue(entry)
+            save_debug("WS ERROR", f"[{bot['room']}] send failed: {e}")
+            raise
+        box.sent(entry)
+        if RECORD["room"]: record(bot, "out", pkt)
+        bot_av = "https://cdn-icons-png.flaticon.com/512/4712/4712035.png"
+        display = "[IMAGE SENT]" if pkt["type"] == "image" else pkt["body"]
+        save_chat(bot, "TitanBot", display, bot_av, "bot")
+        save_debug("OUT", pkt)
+
+def send_msg(bot, text, type="text", url="", coalesce=None):
+    # coalesce: same key ka queued packet replace hota hai (board images ke liye)
+    if not bot: return False
+    if bot["should_run"] and ENGINE["loop"]:
+        pkt = {"handler": "room_message", "id": str(time.time()), "room": bot["room"], "type": type, "body": text, "url": url, "length": "0"}
+        # Reconnect ke dauran bhi queue (block nahi), loop thread pe kabhi block nahi
+        block = bot["ws"] is not None and threading.current_thread() is not ENGINE["thread"]
+        if bot["outbox"].put(pkt, coalesce, block): return True
+    bot["conn"]["dropped_sends"] += 1
+    return False
+
+def start_room(user, password, room, domain, url=CHAT_URL):
+    # (bot, started): already chal raha ho toh started=False
+    key = room.lower()
+    with ROOMS_LOCK:
+        bot = ROOMS.get(key)
+        # Auth fail ke baad retry wait me ho toh naye credentials le lo
+        if bot and bot["should_run"] and not bot["auth_failed"]: return bot, False
+        if bot: bot.update({"user": user, "pass": password, "should_run": True, "domain": domain, "url": url})
+        else: bot = ROOMS[key] = new_room(user, password, room, domain, url)
+        journal_room(bot)
+        loop = start_engine()
+        loop.call_soon_threadsafe(bot["wake"].set)
+        # Purana session abhi retry sleep me ho sakta hai; wo khud should_run dekh ke chalta rahega
+        if not bot["task"] or bot["task"].done():
+            bot["task"] = asyncio.run_coroutine_threadsafe(bot_session(bot), loop)
+    return bot, True
+
+def stop_room(bot):
+    bot["should_run"] = False
+    journal_room(bot)
+    ws, loop = bot["ws"], ENGINE["loop"]
+    if loop: loop.call_soon_threadsafe(bot["wake"].set)
+    if ws and loop: asyncio.run_coroutine_threadsafe(ws.close(), loop)
 
 # =============================================================================
 # 5. GAME ENGINE (LOCKED & SAFE)
 # =============================================================================
-ACTIVE_GAMES = {}
-
-def idle_game_checker():
-    while BOT["should_run"]:
-        time.sleep(5)
-        now = time.time()
-        to_remove = []
-        
-        with GAME_LOCK: # Reading shared state safely
-            for host, game in ACTIVE_GAMES.items():
-                if now - game['last_active'] > 30: # 30 Sec Timeout
-                    to_remove.append(host)
-        
-        for host in to_remove:
-            game = None
-            with GAME_LOCK:
-                if host in ACTIVE_GAMES:
-                    game = ACTIVE_GAMES.pop(host)
-            
-            if game:
-                # Refund logic
-                bet = game.get("bet", 0)
-                if bet > 0:
-                    update_score(game['p1'], bet)
-                    if game['p2'] and "Bot" not in game['p2']: update_score(game['p2'], bet)
-                
-                send_msg(f"🛑 **TIMEOUT!** Game hosted by {host} stopped. Bets refunded.")
-
-def game_engine(user, msg):
+ACTIVE_GAMES = {} # (room, host) -> game
+# Indexes taaki har digit message pe saare games scan na karne padein.
+# In teeno ko sirf neeche wale *_unsafe helpers badalte hain (GAME_LOCK ke andar).
+PLAYER_GAMES = {} # (room, username) -> game (bot ko index nahi karte)
+HOST_KEYS = {} # (room, host.lower()) -> host
+
+# --- BOARD (BITBOARD) ---
+# Board = do n*n-bit masks (X aur O); Python int hai toh 15x15 (225 bits) bhi
+# ek hi int. Jeet sirf last move wale cell se 4 directions me chal ke (har
+# taraf max k-1 cells) = O(K), lines ki list kabhi scan nahi hoti.
+# Variants: !start 4x4, !start 5x5 k4, !start 15x15 (k na do toh min(n, 5)), !start gomoku.
+BOARD_MAX = int(os.environ.get("BOARD_MAX", 15))
+BOARD_ALIASES = {"gomoku": (15, 5)}
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+def parse_variant(parts):
+    # ["5x5", "k4"] -> (5, 4); galat/non-square size ya k -> None
+    n, k = 3, None
+    for p in parts:
+        a, x, b = p.partition("x")
+        if p in BOARD_ALIASES: n, k = BOARD_ALIASES[p]
+        elif x and (a.isdigit() or b.isdigit()):
+            # Size jaisa token ("3x4", "4x") par square nahi -> galat, 3x3 pe chup chap mat jao
+            if not (a.isdigit() and a == b): return None
+            n = int(a)
+        elif p[:1] == "k" and p[1:].isdigit(): k = int(p[1:])
+    k = k or min(n, 5)
+    return (n, k) if 3 <= k <= n <= BOARD_MAX else None
+
+def cell_name(i, n):
+    # Coordinate move syntax: column letter + row (upar se 1), 15x15 pe "h8" = center
+    return "%s%d" % (chr(97 + i % n), i // n + 1)
+
+def parse_cell(msg, n):
+    # "5" (1..n*n) ya "c4" -> cell index, warna None
+    if msg.isdigit(): i = int(msg) - 1
+    elif msg[:1].isalpha() and msg[1:].isdigit():
+        c, r = ord(msg[0]) - 97, int(msg[1:]) - 1
+        i = r * n + c if 0 <= c < n and 0 <= r < n else -1
+    else: return None
+    return i if 0 <= i < n * n else None
+
+def find_run(mask, cell, n, k):
+    # mask me cell se guzarti >= k lambi run ke cells ("0,4,8"), warna ""
+    r, c = divmod(cell, n)
+    for dr, dc in DIRECTIONS:
+        cells = [cell]
+        for sr, sc in ((dr, dc), (-dr, -dc)):
+            rr, cc = r + sr, c + sc
+            for _ in range(k - 1):
+                if not (0 <= rr < n and 0 <= cc < n and mask >> (rr * n + cc) & 1): break
+                cells.append(rr * n + cc)
+                rr, cc = rr + sr, cc + sc
+        if len(cells) >= k: return ",".join(map(str, sorted(cells)))
+    return ""
+
+def board_key(b_str):
+    # "X_O______" -> x_mask | o_mask << 9 (solver table ki key)
+    x = sum(1 << i for i, c in enumerate(b_str) if c == "X")
+    o = sum(1 << i for i, c in enumerate(b_str) if c == "O")
+    return x | (o << 9)
+
+GAME_SERIAL = itertools.count(1)
+
+class Game:
+    __slots__ = ("room", "host", "mode", "p1", "p2", "bet", "level", "turn", "x", "o", "timer", "lock", "over", "n", "k", "serial")
+
+    def __init__(self, room, host, mode, p2=None, bet=0, level=None, n=3, k=3):
+        self.room, self.host, self.mode, self.p1, self.p2 = room, host, mode, host, p2
+        self.bet, self.level = bet, level
+        self.n, self.k = n, k
+        self.turn, self.x, self.o = "X", 0, 0
+        self.timer = None
+        # Game state (board, turn, p2, over) sirf self.lock ke andar badalti hai.
+        # Lock order: game.lock -> GAME_LOCK, ulta kabhi nahi. I/O dono ke bahar.
+        self.lock = threading.Lock()
+        self.over = False
+        # Outbox coalesce key: host ka agla game (same gid) purane ka final board na kha jaaye
+        self.serial = next(GAME_SERIAL)
+
+    @property
+    def key(self): return self.x | (self.o << self.n * self.n)
+
+    @property
+    def gid(self): return (self.room, self.host)
+
+    @property
+    def variant(self): return "" if self.n == 3 else f" {self.n}x{self.n} k{self.k}"
+
+    def is_free(self, cell): return not ((self.x | self.o) >> cell & 1)
+    def is_full(self): return (self.x | self.o) == (1 << self.n * self.n) - 1
+
+    def place(self, cell, sym):
+        # Returns win line ("0,4,8") ya ""
+        bit = 1 << cell
+        if sym == "X": self.x |= bit; mask = self.x
+        else: self.o |= bit; mask = self.o
+        return find_run(mask, cell, self.n, self.k)
+
+    def board_str(self):
+        # Sirf send_board ke liye (render URL ka b= param)
+        x, o = self.x, self.o
+        return "".join("X" if x >> i & 1 else "O" if o >> i & 1 else "_" for i in range(self.n * self.n))
+
+# Timeouts mode ke hisaab se: lobby = PvP game jisme abhi p2 nahi aaya
+GAME_TIMEOUTS = {
+    "lobby": float(os.environ.get("TIMEOUT_LOBBY", 30)),
+    "pvp": float(os.environ.get("TIMEOUT_PVP", 30)),
+    "bot": float(os.environ.get("TIMEOUT_BOT", 30)),
+}
+BOT_MOVE_DELAY = float(os.environ.get("BOT_MOVE_DELAY", 1.0))
+
+def timeout_for(game):
+    if game.mode == "pvp" and not game.p2: return GAME_TIMEOUTS["lobby"]
+    return GAME_TIMEOUTS[game.mode]
+
+def touch_game(game):
+    # Activity: timer dobara arm (purana wheel entry cancel)
+    WHEEL.cancel(game.timer)
+    game.timer = WHEEL.schedule(timeout_for(game), expire_game, game)
+
+def expire_game(game):
+    bot = ROOMS.get(game.room)
+    with game.lock:
+        if game.over: return
+        # Fire hone aur yahan tak aane ke beech move aa gaya -> naya timer already armed.
+        # Wheel ka entry hi dekho, wall clock nahi (replay ka virtual clock, clock step)
+        if WHEEL.armed(game.timer): return
+        if bot and bot["should_run"] and bot["status"] != "ONLINE":
+            # Connection down hai, players move bhej hi nahi sakte: game hold pe
+            game.timer = WHEEL.schedule(timeout_for(game), expire_game, game)
+            return
+        game.over = True
+    end_game(game)
+    refund_game(game)
+    send_msg(bot, f"🛑 **TIMEOUT!** Game hosted by {game.host} stopped. Bets refunded.")
+
+def game_engine(bot, user, msg):
     msg = msg.strip().lower()
+    room = bot["key"]
     
     # --- COMMANDS ---
     if msg == "!help":
-        send_msg("🎮 **COMMANDS:**\n• `!start`\n• `!start bet 100`\n• `!sg`\n• `!join <host>`\n• `!score`\n• `1-9` (Move)")
+        send_msg(bot, "🎮 **COMMANDS:**\n• `!start`\n• `!start b easy|medium|hard`\n• `!start bet 100`\n• `!start 4x4` / `5x5 k4` / `gomoku`\n• `!sg`\n• `!join <host>`\n• `!score`\n• `!rank`\n• `1-9` or `b2` (Move)")
         return
 
+    if msg == "!rank":
+        rank, bal = get_rank(user)
+        if not rank: return send_msg(bot, f"🏅 {user}: not ranked yet. Play a game!")
+        return send_msg(bot, f"🏅 {user}: **#{rank}** with {bal} pts")
+
     if msg == "!score":
-        bal = get_score(user)
-        domain = BOT.get('domain', '')
+        try: bal = get_balance(user)
+        except ScoreReadError: return send_msg(bot, "⚠ Scores busy, try again.")
+        domain = bot.get('domain', '')
         link = f"\n🏆 Rank: {domain}leaderboard" if domain else ""
-        send_msg(f"💳 {user}: **{bal}** pts{link}")
+        send_msg(bot, f"💳 {user}: **{bal}** pts{link}")
         return
 
     # --- START ---
     if msg.startswith("!start"):
-        with GAME_LOCK:
-            if find_user_game_unsafe(user): 
-                return send_msg(f"⚠ {user}, finish current game!")
+        with GAME_LOCK: busy = find_user_game_unsafe(room, user)
+        if busy: return send_msg(bot, f"⚠ {user}, finish current game!")
         
-        mode = "bot" if "b" in msg else "pvp"
+        parts = msg.split()[1:]
+        # Tokens pe: "bet" ka "b" bot mode nahi hai
+        mode = "bot" if "b" in parts or "bot" in parts else "pvp"
+        level = next((p for p in parts if p in BOT_LEVELS), BOT_DEFAULT_LEVEL)
+        variant = parse_variant(parts)
+        if not variant: return send_msg(bot, f"⚠ Board 3x3..{BOARD_MAX}x{BOARD_MAX}, k3..n (e.g. `!start 5x5 k4`)")
         bet = 0
-        if "bet" in msg:
-            try: bet = int(msg.split("bet")[1].split()[0])
+        if "bet" in parts:
+            try: bet = int(parts[parts.index("bet") + 1])
             except: pass
         
-        if bet > 0:
-            if get_score(user) < bet: return send_msg("⚠ Low Balance!")
-            update_score(user, -bet) # Deduct
+        if bet > 0 and not try_debit(user, bet): return send_msg(bot, "⚠ Low Balance!")
+        if bet > 0 and GAME_STATE_DIR and not sync_ledger(user):
+            update_score(user, bet)
+            return send_msg(bot, "⚠ Scores busy, try again.")
             
+        game = Game(room, user, mode, "🤖 TitanBot" if mode=="bot" else None, bet, level, *variant)
+        board = game.board_str()
         with GAME_LOCK:
-            ACTIVE_GAMES[user] = {
-                "host": user, "mode": mode, "board": [" "]*9, "turn": "X",
-                "p1": user, "p2": "🤖 TitanBot" if mode=="bot" else None,
-                "last_active": time.time(), "bet": bet
-            }
+            # Debit ke dauran purana game abhi index se nikla na ho
+            busy = find_user_game_unsafe(room, user) or game.gid in ACTIVE_GAMES
+            if not busy: add_game_unsafe(game)
+        if busy:
+            if bet > 0: update_score(user, bet)
+            return send_msg(bot, f"⚠ {user}, finish current game!")
         
-        send_board(user)
+        send_board(game, board)
         bet_txt = f" (Bet: {bet})" if bet else ""
-        if mode=="pvp": send_msg(f"🎮 **PvP LOBBY{bet_txt}**\nHost: {user}\nWaiting: `!join {user}`")
-        else: send_msg(f"🤖 **BOT MATCH**\n{user} vs TitanBot")
+        if mode=="pvp": send_msg(bot, f"🎮 **PvP LOBBY{game.variant}{bet_txt}**\nHost: {user}\nWaiting: `!join {user}`")
+        else: send_msg(bot, f"🤖 **BOT MATCH{game.variant}** ({level})\n{user} vs TitanBot")
         return
 
     # --- JOIN ---
     if msg.startswith("!join"):
-        with GAME_LOCK:
-            if find_user_game_unsafe(user): return send_msg("⚠ You are playing.")
+        with GAME_LOCK: busy = find_user_game_unsafe(room, user)
+        if busy: return send_msg(bot, "⚠ You are playing.")
         
         parts = msg.split()
-        if len(parts) < 2: return send_msg("Usage: `!join <host>`")
+        if len(parts) < 2: return send_msg(bot, "Usage: `!join <host>`")
         host_target = parts[1]
         
-        game = None
-        target_host_key = None
-        
         with GAME_LOCK:
-            for h in ACTIVE_GAMES:
-                if h.lower() == host_target.lower(): 
-                    game = ACTIVE_GAMES[h]
-                    target_host_key = h
-                    break
+            game = ACTIVE_GAMES.get((room, HOST_KEYS.get((room, host_target.lower()))))
         
-        if not game: return send_msg("⚠ Game not found.")
-        if game["mode"] == "bot" or game["p2"]: return send_msg("⚠ Full/Bot.")
+        if not game: return send_msg(bot, "⚠ Game not found.")
+        if game.mode == "bot" or game.p2: return send_msg(bot, "⚠ Full/Bot.")
         
-        bet = game.get("bet", 0)
-        if bet > 0:
-            if get_score(user) < bet: return send_msg("⚠ Need funds.")
-            update_score(user, -bet) # Deduct
-
-        with GAME_LOCK:
-            ACTIVE_GAMES[target_host_key]["p2"] = user
-            ACTIVE_GAMES[target_host_key]["last_active"] = time.time()
+        bet = game.bet
+        if bet > 0 and not try_debit(user, bet): return send_msg(bot, "⚠ Need funds.")
+        if bet > 0 and GAME_STATE_DIR and not sync_ledger(user):
+            update_score(user, bet)
+            return send_msg(bot, "⚠ Scores busy, try again.")
+
+        with game.lock:
+            # Debit ke dauran game khatam/full ho sakta hai
+            joined = not game.over and not game.p2
+            if joined:
+                with GAME_LOCK:
+                    joined = not find_user_game_unsafe(room, user)
+                    if joined: join_game_unsafe(game, user)
+        if not joined:
+            if bet > 0: update_score(user, bet)
+            return send_msg(bot, "⚠ Game not found.")
             
         pot = f"\n💰 Pot: {bet*2}" if bet else ""
-        send_msg(f"⚔ **MATCH ON!**\n{user} (O) joined {game['p1']}.{pot}")
+        send_msg(bot, f"⚔ **MATCH ON!**\n{user} (O) joined {game.p1}.{pot}")
         return
 
     # --- STOP ---
     if msg == "!stop":
-        with GAME_LOCK:
-            game = find_user_game_unsafe(user)
-            if game:
-                bet = game.get("bet", 0)
-                # Refund
-                if bet > 0:
-                    threading.Thread(target=update_score, args=(game['p1'], bet)).start()
-                    if game['p2'] and "Bot" not in game['p2']: 
-                        threading.Thread(target=update_score, args=(game['p2'], bet)).start()
-                
-                del ACTIVE_GAMES[game['host']]
-                send_msg("🛑 Stopped & Refunded.")
+        with GAME_LOCK: game = find_user_game_unsafe(room, user)
+        if not game: return
+        with game.lock:
+            if game.over: return
+            game.over = True
+        end_game(game)
+        refund_game(game)
+        send_msg(bot, "🛑 Stopped & Refunded.")
         return
 
-    # --- MOVES ---
-    if msg.isdigit():
-        move = int(msg)
-        game = None
-        
-        with GAME_LOCK:
-            game = find_user_game_unsafe(user)
-        
-        if not game or move < 1 or move > 9: return
-        
-        # Update Timer
-        game["last_active"] = time.time()
+    # --- MOVES --- ("5" ya coordinate "c4")
+    if msg.isdigit() or (len(msg) <= 3 and msg[:1].isalpha() and msg[1:].isdigit()):
+        with GAME_LOCK: game = find_user_game_unsafe(room, user)
+        if not game: return
+        idx = parse_cell(msg, game.n)
+        if idx is None: return
         
-        curr = game["p1"] if game["turn"] == "X" else game["p2"]
-        if game["mode"] == "bot":
-            if user != game["p1"] or game["turn"] == "O": return
-        elif user != curr: return
-        
-        idx = move - 1
-        if game["board"][idx] != " ": return send_msg("⚠ Taken!")
-        
-        game["board"][idx] = game["turn"]
-        
-        if process_turn(game, user): return
+        with game.lock:
+            if game.over: return
+            # Update Timer
+            touch_game(game)
+            
+            curr = game.p1 if game.turn == "X" else game.p2
+            if game.mode == "bot":
+                if user != game.p1 or game.turn == "O": return
+            elif user != curr: return
+            
+            taken = not game.is_free(idx)
+            if not taken:
+                win = game.place(idx, game.turn)
+                outcome = game_outcome_unsafe(game, win)
+                if not outcome:
+                    if game.mode == "bot":
+                        game.turn = "O"
+                        schedule(BOT_MOVE_DELAY, run_bot, game.gid)
+                    else: game.turn = "O" if game.turn == "X" else "X"
+                    journal_game(game)
+                board = game.board_str()
         
-        if game["mode"] == "bot":
-            game["turn"] = "O"
-            threading.Timer(1.0, run_bot, args=[game['host']]).start()
+        if taken: return send_msg(bot, "⚠ Taken!")
+        if outcome: return process_turn(game, user, outcome, board, win)
+        if game.mode != "bot": send_board(game, board)
+
+def resume_games(bot):
+    # Reconnect ke baad: room ke games ke timers fresh, current board dobara
+    with GAME_LOCK: games = [g for g in ACTIVE_GAMES.values() if g.room == bot["key"]]
+    boards = []
+    for g in games:
+        with g.lock:
+            if g.over: continue
+            touch_game(g)
+            boards.append((g, g.board_str()))
+    for g, board in boards: send_board(g, board)
+
+# Helper functions (Must be used inside GAME_LOCK)
+def find_user_game_unsafe(room, u):
+    return PLAYER_GAMES.get((room, u))
+
+def add_game_unsafe(game):
+    ACTIVE_GAMES[game.gid] = game
+    HOST_KEYS.setdefault((game.room, game.host.lower()), game.host)
+    PLAYER_GAMES[(game.room, game.p1)] = game
+    touch_game(game)
+    journal_game(game)
+
+def join_game_unsafe(game, user):
+    game.p2 = user
+    PLAYER_GAMES[(game.room, user)] = game
+    touch_game(game)
+    journal_game(game)
+
+def remove_game_unsafe(gid):
+    game = ACTIVE_GAMES.pop(gid, None)
+    if not game: return None
+    WHEEL.cancel(game.timer)
+    journal_game(game, "del")
+    room, host = gid
+    if HOST_KEYS.get((room, host.lower())) == host: del HOST_KEYS[(room, host.lower())]
+    for u in (game.p1, game.p2):
+        if PLAYER_GAMES.get((room, u)) is game: del PLAYER_GAMES[(room, u)]
+    return game
+
+def check_indexes_unsafe():
+    # Debug/stress helper: indexes ACTIVE_GAMES se match karte hain?
+    players = {(g.room, u): g for g in ACTIVE_GAMES.values() for u in (g.p1, g.p2) if u and not (g.mode == "bot" and u == g.p2)}
+    assert PLAYER_GAMES == players, "player index diverged"
+    assert set(HOST_KEYS) == {(r, h.lower()) for r, h in ACTIVE_GAMES}, "host index diverged"
+    assert all((r, h) in ACTIVE_GAMES and h.lower() == k for (r, k), h in HOST_KEYS.items()), "host index points at wrong game"
+
+# --- BOT SOLVER ---
+# 3x3: har reachable position ka minimax ek baar startup pe (5478 states, ~50ms).
+# Bot ka move phir sirf ek dict lookup hai, GAME_LOCK ke andar koi search nahi.
+# Value mover ke hisaab se: jaldi jeet > der se jeet > draw > loss.
+BOT_TABLE = {} # board_key -> {cell: value}
+BOT_LEVELS = {"easy": 0.6, "medium": 0.25, "hard": 0.0} # kamzor (best nahi) move ka chance
+BOT_DEFAULT_LEVEL = os.environ.get("BOT_LEVEL", "medium")
+
+def solve_positions():
+    memo = {}
+    def negamax(b):
+        if b in memo: return memo[b]
+        if find_win_line(b): val = -(b.count("_") + 1) # pichla mover jeet gaya
+        elif "_" not in b: val = 0
         else:
-            game["turn"] = "O" if game["turn"] == "X" else "X"
-            send_board(game['host'])
-
-# Helper function (Must be used inside a LOCK or knowing it's read-only)
-def find_user_game_unsafe(u):
-    for h, d in ACTIVE_GAMES.items():
-        if d['p1'] == u or d['p2'] == u: return d
-    return None
-
-def run_bot(host):
-    with GAME_LOCK:
-        if host not in ACTIVE_GAMES: return
-        game = ACTIVE_GAMES[host]
-        b = game["board"]
-        avail = [i for i,x in enumerate(b) if x == " "]
-        if not avail: return
-        
-        # Logic
-        move = None
-        wins = [(0,1,2),(3,4,5),(6,7,8),(0,3,6),(1,4,7),(2,5,8),(0,4,8),(2,4,6)]
-        for s in ["O", "X"]:
-            for x,y,z in wins:
-                if b[x]==s and b[y]==s and b[z]==" ": move=z; break
-                if b[x]==s and b[z]==s and b[y]==" ": move=y; break
-                if b[y]==s and b[z]==s and b[x]==" ": move=x; break
-            if move: break
-        if not move: move = random.choice(avail)
-        
-        game["board"][move] = "O"
-    
-    # Process turn releases lock internally
-    if process_turn(game, "TitanBot"): return
+            turn = "X" if b.count("X") == b.count("O") else "O"
+            moves = {i: -negamax(b[:i] + turn + b[i+1:]) for i, c in enumerate(b) if c == "_"}
+            BOT_TABLE[board_key(b)] = moves
+            val = max(moves.values())
+        memo[b] = val
+        return val
+    negamax("_"*9)
+
+# Bot ka apna RNG: recording seed karti hai, replay same seed se same moves
+BOT_RNG = random.Random()
+
+def pick_bot_move(key, level):
+    moves = BOT_TABLE.get(key)
+    if not moves: return None
+    best, low, e = max(moves.values()), min(moves.values()), len(moves)
+    # Forced: value e = isi move me jeet, -(e-1) = kuch moves pe agli chaal me haar
+    # (block karna hai). Tab level kuch bhi ho, best move.
+    forced = best == e or low == -(e - 1)
+    if not forced and BOT_RNG.random() < BOT_LEVELS.get(level, 0):
+        # Kamzor move bhi table ke hisaab se: value jitni achhi utna zyada chance
+        cells = list(moves)
+        return BOT_RNG.choices(cells, [moves[c] - low + 1 for c in cells])[0]
+    return BOT_RNG.choice([m for m, v in moves.items() if v == best])
+
+solve_positions()
+
+# --- BOT SEARCH (BADE BOARDS) ---
+# 4x4+ pe table nahi ban sakti. Negamax + alpha-beta, iterative deepening
+# BOT_NODES ke budget me (jo depth poori hui uska best move). Budget nodes me,
+# time me nahi: same board pe har machine/load pe same move (replay bhi).
+# BOT_THINK_MS sirf safety cap hai overloaded machine ke liye (0 = off). Candidates =
+# pathron ke aas paas (1 cell) ke khaali cells, static delta se sorted, top
+# BOT_BRANCH hi khole jaate hain. Eval incremental: har k-window jisme sirf ek
+# player ke pathar hain, uske count ka weight; move pe sirf us cell ki windows.
+BOT_NODES = int(os.environ.get("BOT_NODES", 4000))
+BOT_THINK_MS = float(os.environ.get("BOT_THINK_MS", 1000))
+BOT_MAX_DEPTH = int(os.environ.get("BOT_MAX_DEPTH", 6))
+BOT_BRANCH = int(os.environ.get("BOT_BRANCH", 12))
+BOT_WIN_SCORE = 10**9
+BOARD_GEOMETRY = {} # (n, k) -> (cell windows, neighbour masks, weights)
+BOT_SEARCH = Histogram("tt_bot_search_seconds", "Alpha-beta bot move time (4x4 and bigger)")
+SEARCH_STATS = {"searches": 0, "nodes": 0, "budget_stops": 0, "timeouts": 0, "depth_sum": 0}
+SEARCH_EXECUTOR = GameActors(int(os.environ.get("BOT_SEARCH_WORKERS", 2)))
+
+class SearchTimeout(Exception): pass
+class SearchBudget(Exception): pass
+
+def board_geometry(n, k):
+    geo = BOARD_GEOMETRY.get((n, k))
+    if geo: return geo
+    cells = [[] for _ in range(n * n)]
+    for r in range(n):
+        for c in range(n):
+            for dr, dc in DIRECTIONS:
+                er, ec = r + dr * (k - 1), c + dc * (k - 1)
+                if not (0 <= er < n and 0 <= ec < n): continue
+                line = [(r + dr * j) * n + c + dc * j for j in range(k)]
+                mask = sum(1 << i for i in line)
+                for i in line: cells[i].append(mask)
+    near = [sum(1 << (rr * n + cc) for rr in range(max(0, r - 1), min(n, r + 2)) for cc in range(max(0, c - 1), min(n, c + 2)))
+            for r, c in (divmod(i, n) for i in range(n * n))]
+    weights = [0] + [8 ** j for j in range(k)] # k-1 pathar wali window = ek move se jeet
+    geo = BOARD_GEOMETRY[(n, k)] = (cells, near, weights)
+    return geo
+
+def move_delta(me, opp, cell, cells, weights):
+    # me ke cell khelne se eval kitna badla (me ke hisaab se); k-1 se k hua = jeet
+    d = 0
+    for w in cells[cell]:
+        m, t = (me & w).bit_count(), (opp & w).bit_count()
+        if not t:
+            if m + 1 == len(weights) - 1: return d, True
+            d += weights[m + 1] - weights[m]
+        elif not m: d += weights[t] # opp ki window band
+    return d, False
+
+def search_move(me, opp, n, k, level):
+    # me = bot ke pathar (O), opp = X. Returns cell ya None (board full)
+    cells, near, weights = board_geometry(n, k)
+    occ = me | opp
+    if occ == (1 << n * n) - 1: return None
+    if not occ: return (n // 2) * n + n // 2
+    around = 0
+    for i in range(n * n):
+        if occ >> i & 1: around |= near[i]
+    cands = [i for i in range(n * n) if around >> i & 1 and not occ >> i & 1]
+
+    t0 = time.perf_counter()
+    deadline = t0 + BOT_THINK_MS / 1000 if BOT_THINK_MS > 0 else float("inf")
+    nodes = [0]
+
+    def ordered(me, opp, around):
+        occ = me | opp
+        moves = []
+        for i in range(n * n):
+            if around >> i & 1 and not occ >> i & 1:
+                d, win = move_delta(me, opp, i, cells, weights)
+                if win: return [(BOT_WIN_SCORE, i, True)]
+                moves.append((d, i, False))
+        moves.sort(reverse=True)
+        return moves[:BOT_BRANCH]
+
+    def negamax(me, opp, around, depth, alpha, beta, score, ply):
+        # score = static eval, side to move (me) ke hisaab se
+        nodes[0] += 1
+        if nodes[0] > BOT_NODES: raise SearchBudget()
+        if time.perf_counter() > deadline: raise SearchTimeout()
+        if depth == 0: return score
+        moves = ordered(me, opp, around)
+        if not moves: return 0 # board full = draw
+        if moves[0][2]: return BOT_WIN_SCORE - ply # jaldi jeet better
+        best = -BOT_WIN_SCORE
+        for d, i, _ in moves:
+            val = -negamax(opp, me | 1 << i, around | near[i], depth - 1, -beta, -alpha, -(score + d), ply + 1)
+            if val > best: best = val
+            if best > alpha: alpha = best
+            if alpha >= beta: break
+        return best
+
+    # Root: pichli depth ka best pehle (achhe cutoffs)
+    root = [(d, i) for d, i, _ in ordered(me, opp, around)]
+    # Apni jeet ya opp ki agli chaal me jeet (block) forced hai; warna kamzor level top candidates me se koi bhi
+    forced = len(root) == 1 or any(move_delta(opp, me, i, cells, weights)[1] for i in cands)
+    if not forced and BOT_RNG.random() < BOT_LEVELS.get(level, 0): return BOT_RNG.choice(root)[1]
+    if len(root) == 1 or BOT_MAX_DEPTH < 1: return root[0][1]
+    best_move, depth_done = root[0][1], 0
+    try:
+        for depth in range(1, BOT_MAX_DEPTH + 1):
+            alpha, best_here = -BOT_WIN_SCORE - 1, None
+            for d, i in root:
+                val = -negamax(opp, me | 1 << i, around | near[i], depth - 1, -BOT_WIN_SCORE - 1, -alpha, -d, 1)
+                if val > alpha: alpha, best_here = val, i
+            best_move, depth_done = best_here, depth
+            if alpha >= BOT_WIN_SCORE - depth: break # pakki jeet mil gayi
+            root.sort(key=lambda m: m[1] != best_move)
+    except SearchBudget: SEARCH_STATS["budget_stops"] += 1
+    except SearchTimeout: SEARCH_STATS["timeouts"] += 1
+    SEARCH_STATS["searches"] += 1
+    SEARCH_STATS["nodes"] += nodes[0]
+    SEARCH_STATS["depth_sum"] += depth_done
+    BOT_SEARCH.observe(time.perf_counter() - t0)
+    return best_move
+
+def run_bot(gid):
+    with GAME_LOCK: game = ACTIVE_GAMES.get(gid)
+    if not game: return
+    with game.lock:
+        if game.over or game.turn != "O": return
+        x, o = game.x, game.o
+    level = game.level or BOT_DEFAULT_LEVEL
+    if game.n == 3: return play_bot_move(game, x, o, pick_bot_move(x | (o << 9), level))
+    # Bada board: search (BOT_NODES tak) alag pool pe, game workers saare rooms ke commands ke liye free
+    SEARCH_EXECUTOR.submit(lambda: play_bot_move(game, x, o, search_move(o, x, game.n, game.k, level)))
+
+def play_bot_move(game, x, o, move):
+    # Move lock ke bahar chuna gaya tha: board tab se badla nahi tabhi lagao
+    if move is None: return
+    with game.lock:
+        # Beech me !stop/timeout ho gaya toh chhodo
+        if game.over or game.turn != "O" or (game.x, game.o) != (x, o): return
+        win = game.place(move, "O")
+        outcome = game_outcome_unsafe(game, win)
+        if not outcome:
+            game.turn = "X"
+            journal_game(game)
+        board = game.board_str()
     
+    if outcome: return process_turn(game, "TitanBot", outcome, board, win)
+    send_board(game, board)
+
+def game_outcome_unsafe(game, win):
+    # game.lock ke andar: "win"/"draw" pe game over mark (aur koi move nahi lega), warna None
+    if not win and not game.is_full(): return None
+    game.over = True
+    WHEEL.cancel(game.timer)
+    return "win" if win else "draw"
+
+def end_game(game):
+    # Over game ko indexes se hatao (game.lock ke bahar call karo)
     with GAME_LOCK:
-        if host in ACTIVE_GAMES:
-            ACTIVE_GAMES[host]["turn"] = "X"
-            send_board(host)
-
-def process_turn(game, mover):
-    b = game["board"]
-    win = None
-    wins = [(0,1,2),(3,4,5),(6,7,8),(0,3,6),(1,4,7),(2,5,8),(0,4,8),(2,4,6)]
-    for x,y,z in wins:
-        if b[x]==b[y]==b[z] and b[x]!=" ": win=f"{x},{y},{z}"; break
-        
-    host = game['host']
-    bet = game.get("bet", 0)
+        if ACTIVE_GAMES.get(game.gid) is game: remove_game_unsafe(game.gid)
+
+def refund_game(game):
+    if game.bet > 0:
+        update_score(game.p1, game.bet)
+        if game.p2 and "Bot" not in game.p2: update_score(game.p2, game.bet)
+
+def process_turn(game, mover, outcome, board, win=""):
+    # Game khatam: koi lock nahi pakda hua, yahan scores aur messages
+    end_game(game)
+    bot = ROOMS.get(game.room)
+    bet = game.bet
+    send_board(game, board, win)
     
-    if win:
-        send_board(host, win)
+    if outcome == "win":
         prize = ""
         if "Bot" not in mover:
             amt = bet * 2 if bet > 0 else 50
             # DB Update (Safe)
-            av = BOT["avatars"].get(mover, "")
+            av = bot["avatars"].get(mover, "") if bot else ""
             update_score(mover, amt, av)
             prize = f" (+{amt} pts)"
-            
-        send_msg(f"🏆 **{mover} WINS!**{prize}")
-        
-        with GAME_LOCK:
-            if host in ACTIVE_GAMES: del ACTIVE_GAMES[host]
-        return True
-        
-    elif " " not in b:
-        send_board(host)
-        if bet > 0:
-            # Refund
-            update_score(game['p1'], bet)
-            if game['p2'] and "Bot" not in game['p2']: update_score(game['p2'], bet)
-            
-        send_msg(f"🤝 **DRAW!** Refunded.")
+        send_msg(bot, f"🏆 **{mover} WINS!**{prize}")
+    else:
+        refund_game(game)
+        send_msg(bot, f"🤝 **DRAW!** Refunded.")
+
+# e.g. BOARD_URL_PARAMS="&f=png8&s=450" mobile clients ke liye chhoti images
+BOARD_URL_PARAMS = os.environ.get("BOARD_URL_PARAMS", "")
+
+def send_board(game, board, line=""):
+    # board = game.lock ke andar liya snapshot; yahan sirf URL banana aur queue
+    bot = ROOMS.get(game.room)
+    base = bot.get('domain', '') if bot else ''
+    if not base: return
+    size = f"&n={game.n}" if game.n != 3 else "" # 3x3 URLs purane jaise (cache/pack/recordings)
+    # Koi t= nahi: URL b/w/n se hi content-addressed, immutable header downstream cache hit de
+    url = f"{base}render?b={board}&w={line}&h={game.host}{size}{BOARD_URL_PARAMS}"
+    send_msg(bot, "", "image", url, coalesce=("board", game.serial))
+
+# --- GAME PERSISTENCE (SNAPSHOT + JOURNAL) ---
+# Deploy/restart pe running games aur unki kati hui bets na udein. Har badlav
+# ek line journal me (full row, toh dobara apply karna safe), har
+# SNAPSHOT_INTERVAL sec ya SNAPSHOT_EVERY entries pe poori state snapshot me
+# aur journal naya. File I/O sirf writer thread pe, GAME_LOCK me bas queue.put.
+# Startup: snapshot + uske baad ki journal entries -> games wapas, timers fresh.
+# Rooms ke connection settings bhi saath (cluster mode me wo tt_rooms me): restart
+# pe room khud reconnect, warna restored games bina room ke chupchap timeout.
+GAME_STATE_DIR = os.environ.get("GAME_STATE_DIR", "game_state")
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", 60))
+SNAPSHOT_EVERY = int(os.environ.get("SNAPSHOT_EVERY", 5000))
+JOURNAL = {"seq": 0, "since_snap": 0, "restoring": False, "owner_fd": None}
+JOURNAL_LOCK = threading.Lock()
+JOURNAL_QUEUE = queue.SimpleQueue()
+JOURNAL_STATS = {"entries": 0, "snapshots": 0, "errors": 0, "restored": 0, "restore_ms": 0.0}
+
+def game_row(g): return [g.room, g.host, g.mode, g.p1, g.p2, g.bet, g.level, g.turn, g.x, g.o, g.n, g.k]
+def room_row(b): return [b["key"], b["user"], b["pass"], b["room"], b["domain"], b["url"], b["should_run"]]
+
+def open_private(path, mode):
+    # State files me room passwords bhi hain: sirf owner padh sake
+    f = open(path, mode, encoding="utf-8", opener=lambda p, flags: os.open(p, flags, 0o600))
+    os.chmod(path, 0o600)
+    return f
+
+def journal_game(game, op="put"):
+    if not GAME_STATE_DIR or JOURNAL["restoring"]: return
+    with JOURNAL_LOCK:
+        row = game_row(game) if op == "put" else list(game.gid)
+        JOURNAL["seq"] += 1
+        JOURNAL["since_snap"] += 1
+        JOURNAL_QUEUE.put((JOURNAL["seq"], op, row))
+
+def journal_room(bot):
+    if not GAME_STATE_DIR or CLUSTER_MODE or JOURNAL["restoring"]: return
+    with JOURNAL_LOCK:
+        JOURNAL["seq"] += 1
+        JOURNAL["since_snap"] += 1
+        JOURNAL_QUEUE.put((JOURNAL["seq"], "room", room_row(bot)))
+
+def take_snapshot():
+    # Lock order: GAME_LOCK -> JOURNAL_LOCK (journal_game bhi isi order me)
+    with GAME_LOCK, JOURNAL_LOCK:
+        rows = [game_row(g) for g in ACTIVE_GAMES.values()]
+        rooms = [] if CLUSTER_MODE else [room_row(b) for b in list(ROOMS.values()) if b["should_run"]]
+        JOURNAL["since_snap"] = 0
+        JOURNAL_QUEUE.put((JOURNAL["seq"], "snap", (rows, rooms)))
+
+def write_snapshot(path, seq, rows, rooms):
+    tmp = path + ".tmp"
+    with open_private(tmp, "w") as f:
+        json.dump({"seq": seq, "saved": time.time(), "games": rows, "rooms": rooms}, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path) # atomic: aadha snapshot kabhi nahi dikhega
+
+def journal_writer():
+    snap_path = os.path.join(GAME_STATE_DIR, "snapshot.json")
+    journal_path = os.path.join(GAME_STATE_DIR, "journal.jsonl")
+    f = open_private(journal_path, "a")
+    last_snap = time.monotonic()
+    while True:
+        try: item = JOURNAL_QUEUE.get(timeout=1)
+        except queue.Empty: item = None
+        try:
+            if item:
+                seq, op, row = item
+                if op == "snap":
+                    write_snapshot(snap_path, seq, *row)
+                    # Snapshot me sab aa gaya: journal shuru se (crash beech me ho toh restore seq se skip karta hai)
+                    f.close()
+                    f = open_private(journal_path, "w")
+                    JOURNAL_STATS["snapshots"] += 1
+                else:
+                    f.write(json.dumps([seq, op, row], separators=(",", ":")) + "\n")
+                    JOURNAL_STATS["entries"] += 1
+            if JOURNAL_QUEUE.empty(): f.flush()
+        except Exception as e:
+            JOURNAL_STATS["errors"] += 1
+            print(f"Game Journal Error: {e}")
+        now = time.monotonic()
+        if JOURNAL["since_snap"] and (now - last_snap > SNAPSHOT_INTERVAL or JOURNAL["since_snap"] >= SNAPSHOT_EVERY):
+            take_snapshot()
+            last_snap = now
+
+def claim_game_state():
+    # Non-cluster mode me restore + journal sirf ek process (flock, process marte hi free)
+    os.makedirs(GAME_STATE_DIR, exist_ok=True)
+    fd = os.open(os.path.join(GAME_STATE_DIR, "owner.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try: fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    JOURNAL["owner_fd"] = fd
+    return True
+
+def restore_games():
+    # Snapshot + journal tail -> ACTIVE_GAMES. Journal ki aakhri line crash me adhuri ho sakti hai.
+    os.makedirs(GAME_STATE_DIR, exist_ok=True)
+    t0 = time.perf_counter()
+    rows, rooms, seq = {}, {}, 0
+    try:
+        with open(os.path.join(GAME_STATE_DIR, "snapshot.json"), encoding="utf-8") as f: snap = json.load(f)
+        seq = snap["seq"]
+        rows = {(r[0], r[1]): r for r in snap["games"]}
+        rooms = {r[0]: r for r in snap.get("rooms", [])}
+    except FileNotFoundError: pass
+    except Exception as e: print(f"Snapshot Load Error: {e}")
+    last = seq
+    try:
+        with open(os.path.join(GAME_STATE_DIR, "journal.jsonl"), encoding="utf-8") as f:
+            for line in f:
+                try: n, op, row = json.loads(line)
+                except ValueError: break
+                if n <= seq: continue
+                if op == "put": rows[(row[0], row[1])] = row
+                elif op == "room": rooms[row[0]] = row
+                else: rows.pop(tuple(row), None)
+                last = n
+    except FileNotFoundError: pass
+    
+    JOURNAL["seq"], JOURNAL["restoring"] = last, True
+    try:
         with GAME_LOCK:
-            if host in ACTIVE_GAMES: del ACTIVE_GAMES[host]
+            for room, host, mode, p1, p2, bet, level, turn, x, o, *nk in rows.values():
+                # Purane snapshot rows me n, k nahi = 3x3
+                game = Game(room, host, mode, p2 if mode == "bot" else None, bet, level, *(nk or (3, 3)))
+                game.p1, game.turn, game.x, game.o = p1, turn, x, o
+                add_game_unsafe(game)
+                if p2 and mode == "pvp": join_game_unsafe(game, p2)
+                if mode == "bot" and turn == "O": schedule(BOT_MOVE_DELAY, run_bot, game.gid)
+        # Games ke rooms wapas connect: connection aane tak expire_game unhe hold pe rakhta hai
+        if not CLUSTER_MODE:
+            for key, user, password, room, domain, url, run in rooms.values():
+                if run: start_room(user, password, room, domain, url)
+    finally:
+        JOURNAL["restoring"] = False
+    JOURNAL_STATS["restored"] = len(rows)
+    JOURNAL_STATS["restore_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+    if rows or rooms:
+        take_snapshot() # restored state naye snapshot me, purana journal khatam
+        start_engine() # timeouts chalne chahiye, chahe koi room abhi connect na ho
+
+# --- CLUSTER (MULTI-WORKER) ---
+# CLUSTER_MODE=1: har worker /render, leaderboard aur dashboard serve karta hai,
+# websocket sirf leader ke paas. SQLite (same host) = lock file pe flock,
+# Postgres = tt_leader lease (LEASE_TTL, har CLUSTER_POLL pe renew). Rooms ki
+# desired state tt_rooms me: koi bhi worker /connect likhe, leader reconcile
+# kare. Chat tt_chat me. Leader mara -> lock/lease free -> agla worker leader,
+# games snapshot se wapas (GAME_STATE_DIR shared hona chahiye).
+CLUSTER_MODE = os.environ.get("CLUSTER_MODE", "0") == "1"
+CLUSTER_POLL = float(os.environ.get("CLUSTER_POLL", 2))
+LEASE_TTL = float(os.environ.get("LEASE_TTL", 10))
+LEADER_LOCK_FILE = os.environ.get("LEADER_LOCK_FILE", "titan_ttt.leader")
+LEADERBOARD_REFRESH = float(os.environ.get("LEADERBOARD_REFRESH", 10)) # followers DB se ranking
+CHAT_KEEP = int(os.environ.get("CHAT_KEEP", 5000)) # tt_chat me itni rows
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{BOOT_ID}"
+CLUSTER = {"leader": False, "since": None, "lock_fd": None, "renewed": 0.0, "rank_refreshed": 0.0, "statuses": {}}
+CLUSTER_STATS = {"elections": 0, "renew_failures": 0, "chat_rows": 0, "errors": 0}
+CHAT_QUEUE = queue.SimpleQueue()
+
+def init_cluster_db():
+    id_col = "INTEGER PRIMARY KEY AUTOINCREMENT" if USE_SQLITE else "BIGSERIAL PRIMARY KEY"
+    with DB_LOCK, db_conn() as conn:
+        c = conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS tt_leader (name VARCHAR(64) PRIMARY KEY, owner TEXT, expires_at DOUBLE PRECISION)")
+        c.execute("""CREATE TABLE IF NOT EXISTS tt_rooms (room_key VARCHAR(255) PRIMARY KEY, room TEXT, username TEXT,
+                     password TEXT, domain TEXT, url TEXT, should_run INTEGER, status TEXT, updated DOUBLE PRECISION)""")
+        c.execute(f"CREATE TABLE IF NOT EXISTS tt_chat (id {id_col}, room_key VARCHAR(255), ts DOUBLE PRECISION, username TEXT, msg TEXT, avatar TEXT, type TEXT)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_tt_chat_room ON tt_chat (room_key, id)")
+        conn.commit()
+
+def try_lead():
+    if USE_SQLITE:
+        if CLUSTER["lock_fd"] is not None: return True
+        fd = os.open(LEADER_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        try: fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        CLUSTER["lock_fd"] = fd # process marte hi OS lock chhod deta hai
         return True
-    return False
-
-def send_board(host, line=""):
-    # Read-only access to game state is fine here
-    game = ACTIVE_GAMES.get(host)
-    if not game: return
-    b_str = "".join(game["board"]).replace(" ", "_")
-    base = BOT.get('domain', '')
-    if not base: return
-    url = f"{base}render?b={b_str}&w={line}&h={host}&t={int(time.time())}"
-    send_msg("", "image", url)
+    try:
+        # DB ki ghadi: nodes ke clock skew se farak nahi padta
+        with db_conn() as conn:
+            c = conn.cursor()
+            c.execute("""INSERT INTO tt_leader (name, owner, expires_at) VALUES ('bot', %s, EXTRACT(EPOCH FROM now()) + %s)
+                         ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                         WHERE tt_leader.owner = excluded.owner OR tt_leader.expires_at < EXTRACT(EPOCH FROM now())
+                         RETURNING owner""", (WORKER_ID, LEASE_TTL))
+            row = c.fetchone()
+            conn.commit()
+        if row: CLUSTER["renewed"] = time.monotonic()
+        return bool(row)
+    except Exception as e:
+        CLUSTER_STATS["renew_failures"] += 1
+        print(f"Lease Error: {e}")
+        # Renew nahi hua par lease abhi valid hai toh leader bane raho
+        return CLUSTER["leader"] and time.monotonic() - CLUSTER["renewed"] < LEASE_TTL * 0.8
+
+def release_lead():
+    if not CLUSTER["leader"] or USE_SQLITE: return
+    try:
+        with db_conn() as conn:
+            c = conn.cursor()
+            c.execute("UPDATE tt_leader SET expires_at = 0 WHERE name = 'bot' AND owner = %s", (WORKER_ID,))
+            conn.commit()
+    except Exception: pass
+
+def become_leader():
+    CLUSTER.update(leader=True, since=time.time())
+    CLUSTER_STATS["elections"] += 1
+    print(f"Cluster: {WORKER_ID} is now leader")
+    # Pichhle leader ke score updates DB me hain, memory wale purane
+    load_rankings()
+    invalidate_balance()
+    if GAME_STATE_DIR:
+        restore_games()
+        threading.Thread(target=journal_writer, daemon=True).start()
+    threading.Thread(target=chat_writer, daemon=True).start()
+    start_engine()
+
+def step_down():
+    # Lease kho di (DB down ya kisi aur ne le li). Games/timers ab kisi aur ke:
+    # sessions band karke worker exit, gunicorn naya (follower) worker deta hai.
+    print(f"Cluster: {WORKER_ID} lost leadership, restarting worker")
+    CLUSTER["leader"] = False
+    for bot in list(ROOMS.values()): stop_room(bot)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+def request_room(user, password, room, domain, url, run):
+    # /connect, /disconnect cluster mode me: tt_rooms me likho, leader uthayega
+    ph = "?" if USE_SQLITE else "%s"
+    now = time.time()
+    with db_conn() as conn:
+        c = conn.cursor()
+        if run:
+            c.execute(f"""INSERT INTO tt_rooms (room_key, room, username, password, domain, url, should_run, status, updated)
+                          VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, 1, 'Starting...', {ph})
+                          ON CONFLICT (room_key) DO UPDATE SET room = excluded.room, username = excluded.username,
+                          password = excluded.password, domain = excluded.domain, url = excluded.url,
+                          should_run = 1, status = excluded.status, updated = excluded.updated""",
+                      (room.lower(), room, user, password, domain, url, now))
+        elif room: c.execute(f"UPDATE tt_rooms SET should_run = 0, updated = {ph} WHERE room_key = {ph}", (now, room.lower()))
+        else: c.execute(f"UPDATE tt_rooms SET should_run = 0, updated = {ph}", (now,))
+        conn.commit()
+    if CLUSTER["leader"]: reconcile_rooms()
+    if run: return {"status": "Starting...", "room": room}
+    return {"status": "Stopped", "rooms": [room] if room else "all"}
+
+def reconcile_rooms():
+    # Leader: tt_rooms ki desired state -> ROOMS. Har naya /connect (updated badla) ek baar hi start hota hai,
+    # toh LOGIN FAILED room har poll pe dobara nahi uthta.
+    with db_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT room_key, room, username, password, domain, url, should_run, updated FROM tt_rooms")
+        rows = c.fetchall()
+    for key, room, user, password, domain, url, run, rev in rows:
+        bot = ROOMS.get(key)
+        if run and (not bot or bot.get("rev") != rev):
+            bot, _ = start_room(user, password, room, domain, url or CHAT_URL)
+            bot["rev"] = rev
+        elif not run and bot and bot["should_run"]: stop_room(bot)
+
+def publish_statuses():
+    changed = [(b["status"], k) for k, b in list(ROOMS.items()) if CLUSTER["statuses"].get(k) != b["status"]]
+    if not changed: return
+    ph = "?" if USE_SQLITE else "%s"
+    with db_conn() as conn:
+        c = conn.cursor()
+        c.executemany(f"UPDATE tt_rooms SET status = {ph} WHERE room_key = {ph}", changed)
+        conn.commit()
+    for status, key in changed: CLUSTER["statuses"][key] = status
+
+def chat_writer():
+    # Leader ki chat batch me tt_chat me; purani rows kabhi kabhi trim
+    ph = "?" if USE_SQLITE else "%s"
+    sql = f"INSERT INTO tt_chat (room_key, ts, username, msg, avatar, type) VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph})"
+    written = 0
+    while CLUSTER["leader"]:
+        batch = [CHAT_QUEUE.get()]
+        time.sleep(0.2) # burst ek transaction me
+        while not CHAT_QUEUE.empty() and len(batch) < 500: batch.append(CHAT_QUEUE.get())
+        try:
+            with db_conn() as conn:
+                c = conn.cursor()
+                c.executemany(sql, batch)
+                written += len(batch)
+                if written >= CHAT_KEEP // 10:
+                    c.execute(f"DELETE FROM tt_chat WHERE id <= (SELECT MAX(id) FROM tt_chat) - {ph}", (CHAT_KEEP,))
+                    written = 0
+                conn.commit()
+            CLUSTER_STATS["chat_rows"] += len(batch)
+        except Exception as e:
+            CLUSTER_STATS["errors"] += 1
+            print(f"Chat Write Error: {e}")
+
+def cluster_feed(room, since):
+    # Dashboard data shared tables se: har worker same seq/jawab deta hai.
+    # Debug packets leader-local hain (files me: /debug/search).
+    ph = "?" if USE_SQLITE else "%s"
+    with db_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT room_key, room, status FROM tt_rooms ORDER BY room_key")
+        rooms = c.fetchall()
+        c.execute("SELECT MAX(id) FROM tt_chat")
+        seq = c.fetchone()[0] or 0
+        match = [r for r in rooms if r[0] == room.lower()] or rooms[:1]
+        key = match[0][0] if match else ""
+        reset = since is None or since > seq
+        if reset: c.execute(f"SELECT id, ts, username, msg, avatar, type FROM tt_chat WHERE room_key = {ph} ORDER BY id DESC LIMIT {ph}", (key, CHAT_HISTORY_SIZE))
+        else: c.execute(f"SELECT id, ts, username, msg, avatar, type FROM tt_chat WHERE room_key = {ph} AND id > {ph} AND id <= {ph} ORDER BY id", (key, since, seq))
+        chat = c.fetchall()
+    if reset: chat.reverse()
+    return {"seq": seq, "reset": reset, "chat": [format_chat(r) for r in chat], "debug": [],
+            "status": match[0][2] if match else "DISCONNECTED", "room": match[0][1] if match else "",
+            "rooms": {r[1]: r[2] for r in rooms}}
+
+def cluster_loop():
+    while True:
+        try:
+            lead = try_lead()
+            if lead and not CLUSTER["leader"]: become_leader()
+            elif not lead and CLUSTER["leader"]: step_down()
+            if CLUSTER["leader"]:
+                reconcile_rooms()
+                publish_statuses()
+            elif time.monotonic() - CLUSTER["rank_refreshed"] > LEADERBOARD_REFRESH:
+                load_rankings()
+                CLUSTER["rank_refreshed"] = time.monotonic()
+        except Exception as e:
+            CLUSTER_STATS["errors"] += 1
+            print(f"Cluster Error: {e}")
+        time.sleep(CLUSTER_POLL)
+
+if CLUSTER_MODE:
+    init_cluster_db()
+    atexit.register(release_lead)
+    threading.Thread(target=cluster_loop, daemon=True).start()
+elif GAME_STATE_DIR:
+    if claim_game_state():
+        restore_games()
+        threading.Thread(target=journal_writer, daemon=True).start()
+    else:
+        # Dusra worker (gunicorn -w > 1) owner hai: yahan restore/journal nahi, warna har worker refund dega
+        print("Game state owned by another worker, games here are not persisted (use CLUSTER_MODE=1 for -w > 1)")
+        GAME_STATE_DIR = ""
 
 # =============================================================================
 # 6. FLASK ROUTES
@@ -487,57 +2385,273 @@ def send_board(host, line=""):
 @app.route('/')
 def index(): return render_template_string(UI_TEMPLATE)
 
+def cached_leaderboard(kind):
+    # Rendered HTML/JSON tab tak reuse jab tak top-N same hai
+    with RANK_LOCK:
+        version, cached = RANKING["version"], RANKING[kind]
+    if cached is None:
+        users = top_players()
+        if users is None: users = get_leaderboard_data() # ranking load fail hua tha
+        if kind == "html": body = render_template_string(LEADERBOARD_TEMPLATE, users=users)
+        else: body = json.dumps([{"user": u, "score": sc, "wins": w, "avatar": av} for u, sc, w, av in users])
+        # Content hash ETag: har worker ka version alag hota hai, body nahi
+        cached = (body, hashlib.sha1(body.encode()).hexdigest())
+        with RANK_LOCK:
+            if RANKING["version"] == version: RANKING[kind] = cached
+    body, etag = cached
+    resp = app.response_class(body, mimetype="text/html" if kind == "html" else "application/json")
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache' # har baar revalidate, par 304 pe body nahi aati
+    return resp.make_conditional(request)
+
 @app.route('/leaderboard')
 def leaderboard():
-    users = get_leaderboard_data()
-    return render_template_string(LEADERBOARD_TEMPLATE, users=users)
+    return cached_leaderboard("html")
+
+@app.route('/leaderboard.json')
+def leaderboard_json():
+    return cached_leaderboard("json")
 
 @app.route('/connect', methods=['POST'])
 def connect():
-    if BOT["should_run"]: return jsonify({"status": "Already Running"})
+    # Har call ek naya room jodta hai (same room dobara = Already Running). Optional "url" = chat server
     d = request.json
-    BOT.update({"user": d['u'], "pass": d['p'], "room": d['r'], "should_run": True, "domain": request.url_root})
-    threading.Thread(target=bot_thread, daemon=True).start()
-    return jsonify({"status": "Starting..."})
+    url = d.get('url') or CHAT_URL
+    if CLUSTER_MODE: return jsonify(request_room(d['u'], d['p'], d['r'], request.url_root, url, True))
+    bot, started = start_room(d['u'], d['p'], d['r'], request.url_root, url)
+    return jsonify({"status": "Starting..." if started else "Already Running", "room": bot["room"]})
 
 @app.route('/disconnect', methods=['POST'])
 def disconnect():
-    BOT["should_run"] = False
-    if BOT["ws"]: BOT["ws"].close()
-    return jsonify({"status": "Stopped"})
+    # {"r": room} sirf wo room, warna saare rooms
+    d = request.get_json(silent=True) or {}
+    if CLUSTER_MODE: return jsonify(request_room(None, None, d.get('r'), None, None, False))
+    with ROOMS_LOCK:
+        targets = [ROOMS[d['r'].lower()]] if d.get('r') and d['r'].lower() in ROOMS else ([] if d.get('r') else list(ROOMS.values()))
+    for bot in targets: stop_room(bot)
+    return jsonify({"status": "Stopped", "rooms": [b["room"] for b in targets]})
 
 @app.route('/clear_data', methods=['POST'])
 def clear_data():
-    CHAT_HISTORY.clear()
-    DEBUG_LOGS.clear()
+    with LOG_COND:
+        for bot in list(ROOMS.values()): bot["chat"].clear()
+        DEBUG_LOGS.clear()
+        LOG_SEQ["seq"] += 1
+        LOG_SEQ["cleared"] = LOG_SEQ["seq"]
+        LOG_COND.notify_all()
     return jsonify({"status": "Cleared"})
 
+@app.route('/record', methods=['POST'])
+def record_start():
+    # {"room": r, "path": optional} -> us room ka traffic file me (replay.py ke liye)
+    d = request.get_json(silent=True) or {}
+    bot = ROOMS.get(str(d.get('room', '')).lower()) if d.get('room') else default_room()
+    if not bot: return jsonify({"error": "room not found"}), 404
+    return jsonify({"status": "Recording", "room": bot["room"], "path": start_recording(bot, d.get('path'))})
+
+@app.route('/record/stop', methods=['POST'])
+def record_stop(): return jsonify(dict(stop_recording(), status="Stopped"))
+
+@app.route('/debug/capture', methods=['POST'])
+def debug_capture():
+    d = request.get_json(silent=True) or {}
+    with LOG_COND:
+        if d.get("mode") in ("all", "sample", "off"): DEBUG_CAPTURE["mode"] = d["mode"]
+        for k in ("sample", "max_rate"):
+            if k in d: DEBUG_CAPTURE[k] = int(d[k])
+        cfg = {k: DEBUG_CAPTURE[k] for k in ("mode", "sample", "max_rate", "skipped")}
+    return jsonify(cfg)
+
+@app.route('/debug/search')
+def debug_search():
+    # ?from=<epoch>&to=<epoch>&dir=IN|OUT|ERROR&handler=room_event&limit=500
+    if not DEBUG_LOG_DIR: return jsonify({"error": "file logging disabled"}), 400
+    now = time.time()
+    t_from = request.args.get('from', now - 3600, type=float)
+    t_to = request.args.get('to', now, type=float)
+    limit = min(request.args.get('limit', 500, type=int), 5000)
+    results = search_debug_files(t_from, t_to, request.args.get('dir'), request.args.get('handler'), limit)
+    return jsonify({"count": len(results), "results": results})
+
+@app.route('/debug/stats')
+def debug_stats():
+    stats = dict(DEBUG_FILE_STATS, queue=DEBUG_QUEUE.qsize(), file=DEBUG_FILE["path"], file_size=DEBUG_FILE["size"])
+    with LOG_COND: stats["capture"] = {k: DEBUG_CAPTURE[k] for k in ("mode", "sample", "max_rate", "skipped")}
+    return jsonify(stats)
+
+def selected_room():
+    room = request.args.get('room', '')
+    return ROOMS.get(room.lower()) or default_room()
+
+def room_statuses():
+    return {b["room"]: b["status"] for b in list(ROOMS.values())}
+
 @app.route('/get_data')
 def get_data():
-    return jsonify({"status": BOT["status"], "chat": CHAT_HISTORY, "debug": DEBUG_LOGS})
+    # ?room=<name> (default pehla room) &since=<seq> -> sirf naye entries; kuch nahi badla toh 304
+    since = request.args.get('since', type=int)
+    if CLUSTER_MODE:
+        data = cluster_feed(request.args.get('room', ''), since)
+        etag = f"c-{data['seq']}-{data['room']}-{hashlib.sha1(json.dumps(data['rooms'], sort_keys=True).encode()).hexdigest()[:12]}"
+        if since is not None and request.if_none_match.contains(etag):
+            resp = app.response_class(status=304)
+        else: resp = jsonify(data)
+        resp.set_etag(etag)
+        return resp
+    bot = selected_room()
+    rooms = room_statuses()
+    status = bot["status"] if bot else "DISCONNECTED"
+    etag = f"{BOOT_ID}-{LOG_SEQ['seq']}-{bot and bot['key']}-{hashlib.sha1(json.dumps(rooms, sort_keys=True).encode()).hexdigest()[:12]}"
+    if since is not None and request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+    data = log_snapshot(bot, since)
+    data.update(status=status, room=bot["room"] if bot else "", rooms=rooms)
+    resp = jsonify(data)
+    resp.set_etag(etag)
+    return resp
+
+SSE_MAX_SECONDS = int(os.environ.get("SSE_MAX_SECONDS", 300)) # phir browser khud reconnect karega
+
+@app.route('/stream')
+def stream():
+    # Server-sent events: naye chat/debug entries aate hi push. Last-Event-ID se resume.
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None: since = request.args.get('since', type=int)
+    room = request.args.get('room', '')
+
+    def cluster_events():
+        # Shared tables poll (koi cross-worker notify nahi), har second
+        cursor, last_status, last_room = since, None, None
+        deadline, last_sent = time.time() + SSE_MAX_SECONDS, time.time()
+        yield "retry: 2000\n\n"
+        while time.time() < deadline:
+            data = cluster_feed(room, cursor)
+            if data["room"] != last_room and last_room is not None: data = cluster_feed(room, None)
+            if data["reset"] or data["chat"] or data["rooms"] != last_status:
+                yield f"id: {data['seq']}\ndata: {json.dumps(data)}\n\n"
+                last_sent = time.time()
+            elif time.time() - last_sent > 15:
+                yield ": keepalive\n\n"
+                last_sent = time.time()
+            cursor, last_status, last_room = data["seq"], data["rooms"], data["room"]
+            time.sleep(1)
+
+    def events():
+        cursor, last_status, last_room = since, None, None
+        deadline = time.time() + SSE_MAX_SECONDS
+        last_sent = time.time()
+        yield "retry: 2000\n\n"
+        while time.time() < deadline:
+            with LOG_COND:
+                if cursor is not None and LOG_SEQ["seq"] == cursor and room_statuses() == last_status:
+                    LOG_COND.wait(timeout=1) # status change ke liye bhi har second dekh lo
+            bot = ROOMS.get(room.lower()) or default_room()
+            if bot is not last_room: cursor = None # room badla (ya pehli baar bana) -> full reload
+            last_room = bot
+            data = log_snapshot(bot, cursor)
+            status = room_statuses()
+            if data["reset"] or data["chat"] or data["debug"] or status != last_status:
+                data.update(status=bot["status"] if bot else "DISCONNECTED", room=bot["room"] if bot else "", rooms=status)
+                yield f"id: {data['seq']}\ndata: {json.dumps(data)}\n\n"
+                last_sent = time.time()
+            elif time.time() - last_sent > 15: # proxies idle connection na kaat dein
+                yield ": keepalive\n\n"
+                last_sent = time.time()
+            cursor, last_status = data["seq"], status
+
+    resp = app.response_class(cluster_events() if CLUSTER_MODE else events(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+def pick_render_format():
+    fmt = request.args.get('f')
+    if fmt: return fmt, False
+    # Accept negotiation: sirf explicit image/webp pe, "*/*" pe nahi
+    if "webp" in RENDER_FORMATS and any(m == "image/webp" for m, q in request.accept_mimetypes if q > 0):
+        return "webp", True
+    return RENDER_FORMAT, True
+
+RENDER_REQUEST = Histogram("tt_render_request_seconds", "/render handler time", ("source",))
 
 @app.route('/render')
 def render():
+    t0 = time.perf_counter()
     try:
-        b_str = request.args.get('b', '_________')
-        w_line = request.args.get('w', '')
-        if 'board' not in ASSETS: init_assets()
-        base = ASSETS['board'].copy()
-        x_img, o_img = ASSETS['x'], ASSETS['o']
-        for i, c in enumerate(b_str):
-            if c in ['X', 'O']:
-                sym = x_img if c == 'X' else o_img
-                base.paste(sym, ((i%3)*300, (i//3)*300), sym)
-        if w_line:
-            draw = ImageDraw.Draw(base)
-            idx = [int(k) for k in w_line.split(',')]
-            s, e = idx[0], idx[2]
-            draw.line([((s%3)*300+150, (s//3)*300+150), ((e%3)*300+150, (e//3)*300+150)], fill="#ffd700", width=25)
-        img_io = io.BytesIO()
-        base.save(img_io, 'PNG')
-        img_io.seek(0)
-        return send_file(img_io, mimetype='image/png')
+        fmt, negotiated = pick_render_format()
+        key = normalize_render_key(request.args.get('b', '_________'), request.args.get('w', ''),
+                                   fmt, request.args.get('s', 900), request.args.get('n', 3))
+        packed = get_packed(key)
+        etag, data = packed or get_render(key)
     except: return "Error", 500
+    RENDER_REQUEST.observe(time.perf_counter() - t0, "pack" if packed else "cache")
+
+    if request.if_none_match.contains(etag):
+        with RENDER_LOCK: RENDER_STATS["not_modified"] += 1
+        resp = app.response_class(status=304)
+    else:
+        resp = app.response_class([data], mimetype=RENDER_FORMATS[fmt])
+        resp.content_length = len(data)
+    if negotiated: resp.vary.add('Accept')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
+@app.route('/cache/invalidate', methods=['POST'])
+def cache_invalidate():
+    d = request.get_json(silent=True) or {}
+    invalidate_balance(d.get("user"))
+    return jsonify({"status": "Invalidated"})
+
+@app.route('/db/stats')
+def db_stats():
+    with DB_STATS_LOCK: stats = dict(DB_STATS, pool_size=DB_POOL_SIZE, backend="sqlite" if USE_SQLITE else "postgres")
+    with LEDGER_LOCK: stats["ledger"] = dict(LEDGER_STATS, pending=len(LEDGER["pending"]) + len(LEDGER["inflight"]))
+    with BALANCE_LOCK: stats["balance_cache"] = dict(BALANCE_STATS, size=len(BALANCE_CACHE), capacity=BALANCE_CACHE_SIZE)
+    return jsonify(stats)
+
+@app.route('/render/stats')
+def render_stats():
+    with RENDER_LOCK:
+        stats = dict(RENDER_STATS, size=len(RENDER_CACHE), capacity=RENDER_CACHE_SIZE, packed=len(PACK["index"]))
+    return jsonify(stats)
+
+Gauge("tt_active_games", "Games in progress", lambda: len(ACTIVE_GAMES))
+Gauge("tt_threads", "Live Python threads", threading.active_count)
+Gauge("tt_outbox_depth", "Queued outbound messages", lambda: sum(len(b["outbox"]) for b in list(ROOMS.values())))
+Gauge("tt_rooms_online", "Rooms with an authenticated connection", lambda: sum(b["status"] == "ONLINE" for b in list(ROOMS.values())))
+
+@app.route('/metrics')
+def metrics():
+    return app.response_class(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/cluster/stats')
+def cluster_stats():
+    return jsonify(dict(CLUSTER_STATS, mode=CLUSTER_MODE, worker=WORKER_ID, leader=CLUSTER["leader"], leader_since=CLUSTER["since"]))
+
+@app.route('/games/stats')
+def games_stats():
+    with GAME_LOCK: stats = {"active": len(ACTIVE_GAMES), "players": len(PLAYER_GAMES)}
+    stats["persistence"] = dict(JOURNAL_STATS, seq=JOURNAL["seq"], dir=GAME_STATE_DIR)
+    stats["bot_search"] = dict(SEARCH_STATS, node_budget=BOT_NODES, think_ms=BOT_THINK_MS, branch=BOT_BRANCH)
+    return jsonify(stats)
+
+@app.route('/connection/stats')
+def connection_stats():
+    with ROOMS_LOCK: rooms = list(ROOMS.values())
+    stats = {}
+    for b in rooms:
+        c = dict(b["conn"], status=b["status"])
+        for k in ("attempt_at", "online_at", "down_since"): c.pop(k)
+        stats[b["room"]] = c
+    return jsonify(stats)
+
+@app.route('/outbox/stats')
+def outbox_stats():
+    with ROOMS_LOCK: rooms = list(ROOMS.values())
+    return jsonify({b["room"]: b["outbox"].snapshot() for b in rooms})
 
 # =============================================================================
 # 7. UI TEMPLATES (ADVANCED)
@@ -688,6 +2802,7 @@ UI_TEMPLATE = """
         <header>
             <div style="font-weight:bold;color:#fff">TITAN PANEL</div>
             <div style="display:flex;gap:10px;align-items:center">
+                <select id="room-select" class="btn-sm" onchange="switchRoom(this.value)"></select>
                 <div id="status-badge" class="status-badge">OFFLINE</div>
                 <button onclick="logout()" class="btn-sm" style="border:1px solid #f03;background:none;color:#f03">EXIT</button>
             </div>
@@ -745,10 +2860,17 @@ UI_TEMPLATE = """
             if(!u || !p || !r) return alert("Missing info");
             document.getElementById('login-view').style.display = 'none';
             document.getElementById('app-view').style.display = 'flex';
-            fetch('/connect', {method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({u, p, r})});
+            fetch('/connect', {method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({u, p, r})})
+                .then(() => switchRoom(r)); // abhi connect kiya wahi room dikhao
         }
 
-        function logout() { fetch('/disconnect', {method: 'POST'}); location.reload(); }
+        function logout() {
+            // Sirf dikh raha room band karo; khali body = server saare rooms rok deta hai
+            const r = currentRoom || document.getElementById('room-select').value;
+            if (!r) return location.reload();
+            fetch('/disconnect', {method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({r})})
+                .finally(() => location.reload());
+        }
         function clearData() { fetch('/clear_data', {method: 'POST'}); }
 
         function scrollToBottom(id) {
@@ -770,38 +2892,73 @@ UI_TEMPLATE = """
             a.click();
         }
 
-        setInterval(() => {
-            fetch('/get_data').then(r=>r.json()).then(d => {
-                const badge = document.getElementById('status-badge');
-                badge.innerText = d.status;
-                badge.className = d.status === 'ONLINE' ? 'status-badge status-online' : 'status-badge';
+        // Incremental feed: server sirf naye entries bhejta hai (id > seq)
+        const feed = { seq: null, chat: [], debug: [] };
+        let currentRoom = '', es = null;
 
-                const chatDiv = document.getElementById('chat-container');
-                const chatHtml = d.chat.map(m => `
+        function applyData(d) {
+            const sel = document.getElementById('room-select');
+            const names = Object.keys(d.rooms || {});
+            if (sel.options.length !== names.length) {
+                sel.innerHTML = names.map(n => `<option value="${n}">${n}</option>`).join('');
+            }
+            sel.value = d.room;
+
+            const badge = document.getElementById('status-badge');
+            badge.innerText = d.status;
+            badge.className = d.status === 'ONLINE' ? 'status-badge status-online' : 'status-badge';
+
+            if (d.reset) { feed.chat = []; feed.debug = []; }
+            feed.seq = d.seq;
+            const chatDiv = document.getElementById('chat-container');
+            const debugDiv = document.getElementById('debug-log-area');
+            if (d.reset || d.chat.length) {
+                feed.chat = feed.chat.concat(d.chat).slice(-100);
+                chatDiv.innerHTML = feed.chat.map(m => `
                     <div class="msg-row ${m.type === 'bot' ? 'msg-right' : 'msg-left'}">
                         <img src="${m.avatar}" class="avatar" onerror="this.src='https://cdn-icons-png.flaticon.com/512/149/149071.png'">
                         <div class="bubble"><b>${m.user}</b><br>${m.msg}</div>
                     </div>`).join('');
-                
-                if(chatDiv.innerHTML.length !== chatHtml.length) { 
-                    chatDiv.innerHTML = chatHtml; 
-                    if(currentTab==='chat') scrollToBottom('chat-container'); 
-                }
-
-                const debugDiv = document.getElementById('debug-log-area');
-                const visibleLogs = d.debug.slice(-50); // Show last 50 for performance
-                const debugHtml = visibleLogs.map(l => `
+                if(currentTab==='chat') scrollToBottom('chat-container');
+            }
+            if (d.reset || d.debug.length) {
+                feed.debug = feed.debug.concat(d.debug).slice(-50); // Show last 50 for performance
+                debugDiv.innerHTML = feed.debug.map(l => `
                     <div class="log-entry">
                         <span style="opacity:0.5">[${l.time}]</span> <span class="dir-${l.dir}">${l.dir}</span>
                         <pre style="color:#aaa;margin:0">${JSON.stringify(l.data)}</pre>
                     </div>`).join('');
-                
-                if(debugDiv.innerHTML.length !== debugHtml.length) { 
-                    debugDiv.innerHTML = debugHtml; 
-                    if(currentTab==='debug') scrollToBottom('debug-log-area'); 
-                }
-            });
-        }, 1000);
+                if(currentTab==='debug') scrollToBottom('debug-log-area');
+            }
+        }
+
+        function openStream() {
+            // Push mode: polling band. Reconnect pe browser Last-Event-ID bhejta hai.
+            if (es) es.close();
+            es = new EventSource('/stream?room=' + encodeURIComponent(currentRoom));
+            es.onmessage = e => applyData(JSON.parse(e.data));
+        }
+
+        function switchRoom(r) {
+            currentRoom = r;
+            feed.seq = null;
+            if (window.EventSource) openStream();
+        }
+
+        if (window.EventSource) {
+            openStream();
+        } else {
+            let etag = null;
+            setInterval(() => {
+                const room = 'room=' + encodeURIComponent(currentRoom);
+                const url = feed.seq === null ? '/get_data?' + room : '/get_data?since=' + feed.seq + '&' + room;
+                fetch(url, { headers: etag ? {'If-None-Match': etag} : {} }).then(r => {
+                    if (r.status === 304) return;
+                    etag = r.headers.get('ETag');
+                    return r.json().then(applyData);
+                });
+            }, 1000);
+        }
     </script>
 </body>
 </html>
@@ -0,0 +1,20 @@
+# Render benchmark: har format/size ka encode time aur byte size.
+# Usage: python bench_render.py [boards_per_variant]
+import random
+import sys
+import time
+from app import RENDER_FORMATS, RENDER_SIZES, draw_board, encode_image, iter_positions
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    random.seed(1)
+    sample = random.sample(list(iter_positions()), n)
+    images = [draw_board(b, w) for b, w in sample]
+
+    print(f"{'format':<8}{'size':>6}{'avg ms':>10}{'avg KB':>10}{'total KB':>11}")
+    for fmt in RENDER_FORMATS:
+        for size in RENDER_SIZES:
+            total, t0 = 0, time.perf_counter()
+            for img in images: total += len(encode_image(img, fmt, size))
+            ms = (time.perf_counter() - t0) * 1000 / n
+            print(f"{fmt:<8}{size:>6}{ms:>10.2f}{total/n/1024:>10.1f}{total/1024:>11.0f}")
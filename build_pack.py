@@ -0,0 +1,20 @@
+# Offline board pack builder.
+# Usage: python build_pack.py [boards.pack] [--jobs N] [--formats png,png8] [--sizes 900,450]
+# Phir server ko RENDER_PACK=boards.pack ke saath chalao.
+import argparse
+import os
+import time
+from app import build_pack
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Pre-render every reachable board into one pack file")
+    ap.add_argument("path", nargs="?", default="boards.pack")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--formats", default="png")
+    ap.add_argument("--sizes", default="900")
+    args = ap.parse_args()
+
+    variants = [(f, int(s)) for f in args.formats.split(",") for s in args.sizes.split(",")]
+    t0 = time.time()
+    count, size = build_pack(args.path, jobs=args.jobs, variants=variants)
+    print(f"Packed {count} images ({size/1024/1024:.1f} MB) into {args.path} in {time.time()-t0:.1f}s")
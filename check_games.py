@@ -0,0 +1,100 @@
+# Game index test: start, join, moves, win, draw, stop, timeout aur galat
+# commands game_engine() se chala ke har step ke baad check karta hai ki
+# PLAYER_GAMES / HOST_KEYS, ACTIVE_GAMES se bilkul match karte hain
+# (check_indexes_unsafe) aur jo game/players hone chahiye wahi index me hain.
+# Scratch SQLite (temp dir), koi chat connection nahi. Fail pe exit code 1.
+# Usage: python check_games.py [-v]
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+def main():
+    ap = argparse.ArgumentParser(description="Drive the game lifecycle and assert the game indexes after every step")
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+
+    os.environ.pop("DATABASE_URL", None)
+    os.environ.update(DEBUG_LOG_DIR="", GAME_STATE_DIR="", TIMER_TICK="0.01", BOT_MOVE_DELAY="0.01",
+                      TIMEOUT_LOBBY="0.2", TIMEOUT_PVP="0.2", TIMEOUT_BOT="0.2")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="ttt-check-"))
+    import app as A
+
+    A.start_engine()
+    bot = A.new_room("TitanBot", "x", "check", "http://localhost/")
+    bot["status"] = "ONLINE"
+    A.ROOMS[bot["key"]] = bot
+    room = bot["key"]
+    failures = []
+
+    def step(name, games, players):
+        # games: {host: set(players)} jo abhi active hone chahiye
+        with A.GAME_LOCK:
+            try: A.check_indexes_unsafe()
+            except AssertionError as e: failures.append(f"{name}: {e}")
+            got = {h: {u for u in (g.p1, g.p2) if u and "Bot" not in u} for (r, h), g in A.ACTIVE_GAMES.items() if r == room}
+            indexed = {u for r, u in A.PLAYER_GAMES if r == room}
+        if got != games: failures.append(f"{name}: games {got} != expected {games}")
+        if indexed != players: failures.append(f"{name}: indexed players {indexed} != expected {players}")
+        if args.verbose: print(f"{'FAIL' if failures and failures[-1].startswith(name) else 'ok  '} {name}")
+
+    def say(user, *msgs):
+        for m in msgs: A.game_engine(bot, user, m)
+
+    def wait_for(cond, timeout=2):
+        deadline = time.time() + timeout
+        while not cond() and time.time() < deadline: time.sleep(0.01)
+
+    say("al", "!start")
+    step("pvp start", {"al": {"al"}}, {"al"})
+    say("al", "!start")
+    step("double start ignored", {"al": {"al"}}, {"al"})
+    say("al", "!join al")
+    step("join own game refused", {"al": {"al"}}, {"al"})
+    say("cy", "!join nobody")
+    step("join missing game", {"al": {"al"}}, {"al"})
+    say("bo", "!join AL")
+    step("join (host case-insensitive)", {"al": {"al", "bo"}}, {"al", "bo"})
+    say("cy", "!join al")
+    step("join full game refused", {"al": {"al", "bo"}}, {"al", "bo"})
+    say("bo", "5")
+    step("move out of turn", {"al": {"al", "bo"}}, {"al", "bo"})
+    say("al", "1"); say("bo", "4"); say("al", "2"); say("bo", "5"); say("al", "3")
+    step("win", {}, set())
+
+    say("al", "!start"); say("bo", "!join al")
+    for user, cell in zip(["al", "bo"] * 5, "123546879"): say(user, cell)
+    step("draw", {}, set())
+
+    say("bo", "!start"); say("al", "!join bo")
+    say("al", "!stop")
+    step("stop by guest", {}, set())
+    say("bo", "!start")
+    step("host restarts after stop", {"bo": {"bo"}}, {"bo"})
+    say("bo", "!stop")
+    step("stop lobby", {}, set())
+
+    say("cy", "!start b hard")
+    step("bot start", {"cy": {"cy"}}, {"cy"})
+    say("cy", "5")
+    wait_for(lambda: A.ACTIVE_GAMES.get((room, "cy")) and A.ACTIVE_GAMES[(room, "cy")].turn == "X")
+    step("bot replied", {"cy": {"cy"}}, {"cy"})
+    say("cy", "!stop")
+    step("stop bot game", {}, set())
+
+    say("al", "!start"); say("dee", "!start 4x4"); say("ed", "!join dee")
+    step("two lobbies", {"al": {"al"}, "dee": {"dee", "ed"}}, {"al", "dee", "ed"})
+    wait_for(lambda: not A.ACTIVE_GAMES)
+    step("timeout", {}, set())
+
+    if failures:
+        print("FAILED:")
+        for f in failures: print("  " + f)
+        return 1
+    print("game indexes OK")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+# Replay regression: fake chat server pe ek live session record karta hai jisme
+# lobby TIMEOUT (aur uske baad ka "not found" join), PvP jeet, 3x3 aur 5x5 bot games hain,
+# phir replay.py se wapas chala ke outbound match dekhta hai. Timeouts aur bot
+# moves replay ke virtual clock pe bhi usi order me aane chahiye.
+# Scratch dir (temp), koi prod DB/chat nahi. Fail pe exit code 1.
+# Usage: python check_replay.py [--port 8790] [--keep]
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (user, message, baad me kitna rukna) -- lobby timeout 1s hai
+SCRIPT = [
+    ("al", "!start", 1.6), ("bo", "!join al", 0.3),
+    ("al", "!start", 0.3), ("bo", "!join al", 0.3),
+    ("al", "1", 0.2), ("bo", "4", 0.2), ("al", "2", 0.2), ("bo", "5", 0.2), ("al", "3", 0.3),
+    ("bo", "!start b easy", 0.3), ("bo", "5", 0.6), ("bo", "1", 0.6), ("bo", "!stop", 0.3),
+    ("cy", "!start b 5x5 k4", 0.3), ("cy", "c3", 0.8), ("cy", "b2", 0.8), ("cy", "d4", 0.8), ("cy", "!stop", 0.3),
+]
+
+async def chat_clients(url, room):
+    from websockets.asyncio.client import connect
+    socks = {}
+    for user in sorted({u for u, _, _ in SCRIPT}):
+        ws = socks[user] = await connect(url)
+        await ws.send(json.dumps({"handler": "login", "id": user, "username": user, "password": "x"}))
+        await ws.send(json.dumps({"handler": "room_join", "id": user, "name": room}))
+    await asyncio.sleep(0.3)
+    for user, body, pause in SCRIPT:
+        await socks[user].send(json.dumps({"handler": "room_message", "id": str(time.time()), "room": room, "type": "text", "body": body, "url": "", "length": "0"}))
+        await asyncio.sleep(pause)
+    for ws in socks.values(): await ws.close()
+
+def main():
+    ap = argparse.ArgumentParser(description="Record a live session with timeouts and check that replay.py reproduces it")
+    ap.add_argument("--port", type=int, default=8790)
+    ap.add_argument("--keep", action="store_true", help="recording path print karo, scratch dir mat hatao")
+    args = ap.parse_args()
+
+    url = f"ws://127.0.0.1:{args.port}/server"
+    os.environ.pop("DATABASE_URL", None)
+    os.environ.update(DEBUG_LOG_DIR="", GAME_STATE_DIR="", CHAT_URL=url, TIMER_TICK="0.05", BOT_MOVE_DELAY="0.2",
+                      TIMEOUT_LOBBY="1", TIMEOUT_PVP="5", TIMEOUT_BOT="5")
+    sys.path.insert(0, HERE)
+    scratch = tempfile.mkdtemp(prefix="ttt-check-replay-")
+    os.chdir(scratch)
+    import fake_chat_server
+    import app as A
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_until_complete, args=(fake_chat_server.run("127.0.0.1", args.port),), daemon=True).start()
+    time.sleep(0.3)
+    bot, _ = A.start_room("TitanBot", "x", "Lobby", "http://localhost/")
+    deadline = time.time() + 5
+    while bot["status"] != "ONLINE" and time.time() < deadline: time.sleep(0.05)
+    if bot["status"] != "ONLINE":
+        print(f"bot never came online: {bot['status']}")
+        return 1
+
+    path = os.path.join(scratch, "rec.jsonl")
+    A.start_recording(bot, path)
+    asyncio.run_coroutine_threadsafe(chat_clients(url, "Lobby"), loop).result()
+    A.stop_recording()
+
+    with open(path, encoding="utf-8") as f: records = [json.loads(line) for line in f][1:]
+    bodies = [r["data"].get("body", "") for r in records if r["dir"] == "out"]
+    if not any("TIMEOUT" in b for b in bodies):
+        print("recording has no TIMEOUT, nothing to check (machine too slow?)")
+        return 1
+    if args.keep: print(f"recording: {path}")
+
+    out = subprocess.run([sys.executable, os.path.join(HERE, "replay.py"), path], capture_output=True, text=True)
+    print(out.stdout.strip())
+    if out.returncode: print(out.stderr.strip())
+    return out.returncode
+
+if __name__ == '__main__':
+    sys.exit(main())
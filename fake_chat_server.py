@@ -0,0 +1,61 @@
+# Local chat server stand-in (sirf wo protocol jo bot use karta hai):
+# login -> login_event, room_join, room_message -> room_event broadcast, ping.
+# Usage: python fake_chat_server.py [--port 8765] [--reject-password bad]
+# Phir bot ko CHAT_URL=ws://127.0.0.1:8765/server ya /connect {"url": ...} se yahan lao.
+import argparse
+import asyncio
+import json
+import time
+from websockets.asyncio.server import broadcast, serve
+
+ROOMS = {} # room.lower() -> {ws: username}
+STATS = {"logins": 0, "messages": 0, "delivered": 0}
+
+def make_handler(reject_password=None):
+    async def handler(ws):
+        user, joined = None, set()
+        try:
+            async for raw in ws:
+                try: d = json.loads(raw)
+                except ValueError: continue
+                h = d.get("handler")
+                if h == "login":
+                    ok = d.get("password") != reject_password
+                    user = d.get("username") if ok else None
+                    STATS["logins"] += ok
+                    await ws.send(json.dumps({"handler": "login_event", "id": d.get("id"), "type": "success" if ok else "failure", "username": d.get("username")}))
+                elif h == "ping":
+                    await ws.send(json.dumps({"handler": "ping"}))
+                elif not user:
+                    continue
+                elif h == "room_join":
+                    key = str(d.get("name", "")).lower()
+                    ROOMS.setdefault(key, {})[ws] = user
+                    joined.add(key)
+                    await ws.send(json.dumps({"handler": "room_event", "type": "you_joined", "name": d.get("name")}))
+                elif h == "room_message":
+                    key = str(d.get("room", "")).lower()
+                    if key not in joined: continue
+                    STATS["messages"] += 1
+                    evt = json.dumps({"handler": "room_event", "type": d.get("type", "text"), "room": d.get("room"), "from": user,
+                                      "body": d.get("body", ""), "url": d.get("url", ""), "avatar_url": "", "ts": time.time()})
+                    peers = [p for p in ROOMS.get(key, ()) if p is not ws]
+                    broadcast(peers, evt) # slow peer baaki ko nahi rokta
+                    STATS["delivered"] += len(peers)
+        finally:
+            for key in joined: ROOMS.get(key, {}).pop(ws, None)
+    return handler
+
+async def run(host, port, reject_password=None):
+    async with serve(make_handler(reject_password), host, port, ping_interval=None, max_queue=None):
+        print(f"Fake chat server on ws://{host}:{port}/server")
+        await asyncio.Future()
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Local stand-in for the chat websocket server")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--reject-password", default=None, help="is password wala login fail hoga (auth failure test)")
+    args = ap.parse_args()
+    try: asyncio.run(run(args.host, args.port, args.reject_password))
+    except KeyboardInterrupt: print(STATS)
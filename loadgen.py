@@ -0,0 +1,148 @@
+# Load generator: saikdon players fake chat server pe games start/join/play karte hain.
+# Latency = move bhejne se us move wala board image aane + /render fetch tak.
+# Usage:
+#   python fake_chat_server.py &
+#   OUTBOX_RATE=1000 OUTBOX_BURST=1000 gunicorn app:app -b 127.0.0.1:5000 --worker-class gthread --threads 16 &
+#   python loadgen.py --players 200 --rooms 10 --duration 30
+# (Asli server ke liye outbox rate limit sahi hai; load test me use hata do warna wahi bottleneck hai.)
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from urllib.parse import parse_qs, urlparse
+import requests
+from websockets.asyncio.client import connect
+
+# X jeet jaata hai 5 moves me (0,1,2 line) - har move pe board image aata hai
+MOVES = (0, 3, 1, 4, 2)
+RESULTS = {"latency": [], "moves": 0, "games": 0, "timeouts": 0, "bytes": 0}
+
+class Player:
+    def __init__(self, name, ws):
+        self.name, self.ws = name, ws
+
+    async def say(self, room, body):
+        await self.ws.send(json.dumps({"handler": "room_message", "id": str(time.time()), "room": room, "type": "text", "body": body, "url": "", "length": "0"}))
+
+class Pair:
+    def __init__(self, room, host, guest):
+        self.room, self.host, self.guest = room, host, guest
+        self.lobby, self.matched = asyncio.Event(), asyncio.Event()
+        self.boards = asyncio.Queue()
+
+async def join(url, room, name):
+    ws = await connect(url, ping_interval=None, max_queue=None)
+    await ws.send(json.dumps({"handler": "login", "id": str(time.time()), "username": name, "password": "x", "platform": "web"}))
+    await ws.send(json.dumps({"handler": "room_join", "id": str(time.time()), "name": room}))
+    return Player(name, ws)
+
+async def drain(ws):
+    try:
+        async for _ in ws: pass
+    except Exception: pass
+
+async def observe(ws, pairs, bot_name):
+    # Room ka ek connection bot ke messages pairs tak pahunchata hai
+    try:
+        async for raw in ws:
+            d = json.loads(raw)
+            if d.get("handler") != "room_event" or d.get("from") != bot_name: continue
+            body = d.get("body") or ""
+            if d.get("type") == "image":
+                q = parse_qs(urlparse(d["url"]).query)
+                pair = pairs.get(q.get("h", [""])[0])
+                if pair: pair.boards.put_nowait((q.get("b", [""])[0], d["url"]))
+            elif "Waiting: `!join " in body:
+                pair = pairs.get(body.rsplit("!join ", 1)[1].strip("`"))
+                if pair: pair.lobby.set()
+            elif "MATCH ON" in body:
+                pair = pairs.get(body.rsplit(" joined ", 1)[1].split(".")[0])
+                if pair: pair.matched.set()
+    except Exception: pass
+
+def fetch(url):
+    r = requests.get(url, timeout=10)
+    r.raise_for_status()
+    return len(r.content)
+
+async def wait_board(pair, cell, timeout):
+    while True:
+        board, url = await asyncio.wait_for(pair.boards.get(), timeout)
+        if len(board) == 9 and board[cell] != "_": return url
+
+async def play(pair, deadline, timeout):
+    host, guest = pair.host, pair.guest
+    while time.time() < deadline:
+        pair.lobby.clear(); pair.matched.clear()
+        try:
+            await host.say(pair.room, "!start")
+            await asyncio.wait_for(pair.lobby.wait(), timeout)
+            await guest.say(pair.room, f"!join {host.name}")
+            await asyncio.wait_for(pair.matched.wait(), timeout)
+            while not pair.boards.empty(): pair.boards.get_nowait()
+            for i, cell in enumerate(MOVES):
+                t0 = time.perf_counter()
+                await (host if i % 2 == 0 else guest).say(pair.room, str(cell + 1))
+                url = await wait_board(pair, cell, timeout)
+                n = await asyncio.to_thread(fetch, url) # await pehle, warna += purana total likh deta hai
+                RESULTS["bytes"] += n
+                RESULTS["latency"].append(time.perf_counter() - t0)
+                RESULTS["moves"] += 1
+            RESULTS["games"] += 1
+        except asyncio.TimeoutError:
+            RESULTS["timeouts"] += 1
+            await host.say(pair.room, "!stop")
+            await guest.say(pair.room, "!stop")
+
+def pct(values, p):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def main(args):
+    rooms = [f"{args.room_prefix}{i}" for i in range(args.rooms)]
+    for room in rooms:
+        r = requests.post(f"{args.app}/connect", json={"u": args.bot, "p": args.password, "r": room, "url": args.url}, timeout=10)
+        print(room, r.json())
+    await asyncio.sleep(args.warmup)
+
+    counter = itertools.count()
+    tasks, conns, all_pairs = [], [], []
+    per_room = max(2, args.players // args.rooms // 2 * 2)
+    for room in rooms:
+        pairs = {}
+        players = [await join(args.url, room, f"lg{next(counter)}") for _ in range(per_room)]
+        watcher = await join(args.url, room, f"watch-{room}")
+        conns += [p.ws for p in players] + [watcher.ws]
+        tasks.append(asyncio.create_task(observe(watcher.ws, pairs, args.bot)))
+        tasks += [asyncio.create_task(drain(p.ws)) for p in players]
+        for host, guest in zip(players[::2], players[1::2]):
+            pairs[host.name] = Pair(room, host, guest)
+        all_pairs += pairs.values()
+
+    print(f"{len(all_pairs)} games across {len(rooms)} rooms, {len(all_pairs) * 2} players, {args.duration}s")
+    t0 = time.time()
+    await asyncio.gather(*(play(p, t0 + args.duration, args.timeout) for p in all_pairs))
+    elapsed = time.time() - t0
+
+    for t in tasks: t.cancel()
+    for ws in conns: await ws.close()
+    lat = RESULTS["latency"]
+    print(f"moves: {RESULTS['moves']} ({RESULTS['moves']/elapsed:.1f}/s)  games: {RESULTS['games']} ({RESULTS['games']/elapsed:.1f}/s)  timeouts: {RESULTS['timeouts']}")
+    print(f"move->image latency ms: p50 {pct(lat, 50)*1000:.1f}  p99 {pct(lat, 99)*1000:.1f}  max {max(lat, default=0)*1000:.1f}")
+    print(f"render bytes: {RESULTS['bytes']/max(1, RESULTS['moves'])/1024:.1f} KB/move")
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Concurrent players against the bot via the fake chat server")
+    ap.add_argument("--url", default="ws://127.0.0.1:8765/server", help="chat server (fake_chat_server.py)")
+    ap.add_argument("--app", default="http://127.0.0.1:5000", help="bot ka Flask app")
+    ap.add_argument("--players", type=int, default=200)
+    ap.add_argument("--rooms", type=int, default=10)
+    ap.add_argument("--duration", type=float, default=30)
+    ap.add_argument("--timeout", type=float, default=15, help="ek step ka max wait")
+    ap.add_argument("--warmup", type=float, default=1.0)
+    ap.add_argument("--bot", default="TitanBot")
+    ap.add_argument("--password", default="x")
+    ap.add_argument("--room-prefix", default="load")
+    asyncio.run(main(ap.parse_args()))
@@ -0,0 +1,133 @@
+# Recorded traffic replay: capture (POST /record se bani JSONL) ko stub socket ke
+# saath on_message() me wapas daalta hai, outbound packets recording se match
+# karta hai aur har message ka processing time batata hai.
+# Usage: python replay.py recordings/rec-lobby-....jsonl [--pace 1.0] [--slowest 10]
+# --pace 0 (default) = jitna tez ho sake; 1.0 = recorded speed. Virtual clock pe
+# timer wheel chalta hai, toh bot moves/timeouts dono modes me same order me aate hain.
+# Header me recording ke waqt ke BOT_MOVE_DELAY, TIMEOUT_*, BOT_LEVEL, TIMER_TICK,
+# BOARD_URL_PARAMS aur bade board search ke BOT_NODES/BOT_MAX_DEPTH/BOT_BRANCH
+# hain, replay wahi laga ke chalta hai (env se farak nahi). BOT_THINK_MS cap
+# replay me off: live me cap lag gaya ho (/games/stats timeouts) toh move alag ho sakta hai.
+# Scratch SQLite (temp dir) use hota hai: recording ke waqt ke balances nahi hote,
+# toh bet wale sessions me "Low Balance" jaisa farak mismatch me dikhega.
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+class InlineExecutor:
+    # game_engine usi thread pe: per-message time me poora kaam aata hai
+    def submit(self, fn, *args, key=None):
+        f = Future()
+        try: f.set_result(fn(*args))
+        except Exception as e: f.set_exception(e)
+        return f
+
+class StubSocket:
+    def __init__(self): self.sent = []
+    async def send(self, data): self.sent.append(json.loads(data))
+    async def close(self): pass
+
+def normalize(pkt):
+    # id har run me badalta hai; purani recordings ke board urls me t= bhi tha
+    if pkt.get("handler") != "room_message": return None
+    return (pkt.get("type"), pkt.get("body"), re.sub(r"&t=\d+", "", pkt.get("url", "")))
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+def apply_config(A, cfg):
+    # Recording ke waqt ki settings (v1 recordings me nahi: tab current env)
+    if not cfg: return
+    A.BOT_MOVE_DELAY, A.BOT_DEFAULT_LEVEL = cfg["bot_move_delay"], cfg["bot_level"]
+    A.GAME_TIMEOUTS.update(cfg["timeouts"])
+    A.BOARD_URL_PARAMS = cfg["board_url_params"]
+    A.WHEEL = A.TimerWheel(cfg["timer_tick"])
+    # Bade board ka search: recorded depth/branch/node budget (purane headers me nahi = current)
+    A.BOT_NODES = cfg.get("bot_nodes", A.BOT_NODES)
+    A.BOT_MAX_DEPTH, A.BOT_BRANCH = cfg.get("bot_max_depth", A.BOT_MAX_DEPTH), cfg.get("bot_branch", A.BOT_BRANCH)
+
+async def run(A, header, records, pace):
+    now = {"t": 0.0}
+    apply_config(A, header.get("config"))
+    A.WHEEL = A.TimerWheel(A.WHEEL.tick, clock=lambda: now["t"])
+    bot = A.new_room(header["user"], "", header["room"], header.get("domain", "http://localhost/"))
+    bot["outbox"] = A.Outbox(10**6, 10**9, 10**9)
+    bot["status"], bot["ws"] = "ONLINE", StubSocket()
+    A.ROOMS[bot["key"]] = bot
+    A.ENGINE["loop"], A.ENGINE["thread"] = asyncio.get_running_loop(), threading.current_thread()
+    A.BOT_RNG.seed(header["seed"])
+
+    async def settle(t):
+        # Virtual time t tak timers chalao, phir outbox khali hone do
+        now["t"] = max(now["t"], t)
+        for _, fn, args, _ in A.WHEEL.advance(): fn(*args)
+        if not bot["writer"] or bot["writer"].done():
+            bot["writer"] = asyncio.create_task(A.outbound_writer(bot, bot["ws"]))
+        while len(bot["outbox"]): await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    timings, started = [], time.perf_counter()
+    for rec in records:
+        if rec["dir"] != "in": continue
+        if pace: await asyncio.sleep(max(0, started + rec["t"] / pace - time.perf_counter()))
+        await settle(rec["t"])
+        writer = bot["writer"]
+        t0 = time.perf_counter()
+        await A.on_message(bot, bot["ws"], rec["data"])
+        if bot["writer"] is not writer: writer.cancel() # login_event naya writer banata hai
+        await settle(rec["t"])
+        timings.append((time.perf_counter() - t0, rec))
+    # Aakhri bot moves / timeouts jo recording me aaye
+    await settle(max((r["t"] for r in records), default=0) + A.WHEEL.tick)
+    bot["writer"].cancel()
+    return bot["ws"].sent, timings, time.perf_counter() - started
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay a recorded room session through on_message()")
+    ap.add_argument("path")
+    ap.add_argument("--pace", type=float, default=0, help="0 = as fast as possible, 1.0 = recorded speed")
+    ap.add_argument("--slowest", type=int, default=5)
+    args = ap.parse_args()
+
+    with open(args.path, encoding="utf-8") as f:
+        header, *records = [json.loads(line) for line in f if line.strip()]
+    # Import se pehle: scratch DB, koi debug file nahi, prod DATABASE_URL kabhi nahi
+    os.environ.pop("DATABASE_URL", None)
+    os.environ["DEBUG_LOG_DIR"] = ""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="ttt-replay-"))
+    import app as A
+    A.GAME_EXECUTOR = A.SEARCH_EXECUTOR = InlineExecutor()
+    A.BOT_THINK_MS = 0 # wall-clock cap nahi: search sirf node budget pe, machine speed se move nahi badalta
+
+    sent, timings, elapsed = asyncio.run(run(A, header, records, args.pace))
+
+    expected = [n for n in (normalize(r["data"]) for r in records if r["dir"] == "out") if n]
+    got = [n for n in map(normalize, sent) if n]
+    mismatch = next((i for i, (e, g) in enumerate(zip(expected, got)) if e != g), None)
+    if mismatch is None and len(expected) != len(got): mismatch = min(len(expected), len(got))
+
+    times = [t for t, _ in timings]
+    print(f"{len(timings)} inbound messages in {elapsed:.3f}s, outbound {len(got)} (recorded {len(expected)})")
+    if times:
+        print(f"per message ms: mean {sum(times)/len(times)*1000:.3f}  p50 {pct(times, 50)*1000:.3f}  p99 {pct(times, 99)*1000:.3f}  max {max(times)*1000:.3f}")
+    for t, rec in sorted(timings, key=lambda x: x[0], reverse=True)[:args.slowest]:
+        print(f"  {t*1000:8.3f} ms  t={rec['t']:.2f}  {rec['data'][:100]}")
+    if mismatch is None:
+        print("OUTBOUND MATCH")
+        return 0
+    print(f"OUTBOUND MISMATCH at packet {mismatch}:")
+    print(f"  recorded: {expected[mismatch] if mismatch < len(expected) else '<none>'}")
+    print(f"  replayed: {got[mismatch] if mismatch < len(got) else '<none>'}")
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+# Concurrency stress: kai threads, kai rooms, random commands asli dispatch path
+# (per-user mailboxes + per-game locks) se; saath me chhote timeouts taaki
+# !stop / move / timeout / bot move aapas me race karein. Beech beech me aur
+# end me invariants check:
+#   - PLAYER_GAMES / HOST_KEYS indexes ACTIVE_GAMES se match (check_indexes_unsafe)
+#   - active game ka board valid (X-O count 0/1, koi poori line nahi, over nahi)
+#   - har game ek hi baar settle (refund/payout), started == ended + active
+#   - balances = 100 * users + saare update_score deltas, koi negative nahi, cache == DB
+# Usage: python stress_games.py [--rooms 4] [--users 40] [--threads 8] [--duration 10]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+def main():
+    ap = argparse.ArgumentParser(description="Hammer many games concurrently and check invariants")
+    ap.add_argument("--rooms", type=int, default=4)
+    ap.add_argument("--users", type=int, default=40, help="per room")
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--duration", type=float, default=10)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    # Import se pehle: scratch DB, koi files nahi, chhote timeouts
+    os.environ.pop("DATABASE_URL", None)
+    os.environ.update(DEBUG_LOG_DIR="", GAME_STATE_DIR="", OUTBOX_SIZE=str(10**7), TIMER_TICK="0.01",
+                      TIMEOUT_LOBBY="0.5", TIMEOUT_PVP="0.5", TIMEOUT_BOT="0.5", BOT_MOVE_DELAY="0.01", BOT_THINK_MS="5")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="ttt-stress-"))
+    import app as A
+
+    # Hisaab ke liye wrappers (behaviour same)
+    acct = {"credits": 0, "debits": 0, "started": 0, "ended": 0}
+    settled, errors = {}, []
+    lock = threading.Lock()
+    orig_update, orig_debit, orig_add, orig_remove = A.update_score, A.try_debit, A.add_game_unsafe, A.remove_game_unsafe
+    orig_refund, orig_process = A.refund_game, A.process_turn
+
+    def update_score(u, points, avatar_url=""):
+        with lock: acct["credits"] += points
+        orig_update(u, points, avatar_url)
+    def try_debit(u, amount):
+        ok = orig_debit(u, amount) # andar update_score(-amount) hi chalta hai
+        if ok:
+            with lock: acct["debits"] += amount
+        return ok
+    def add_game_unsafe(game):
+        acct["started"] += 1 # GAME_LOCK ke andar
+        orig_add(game)
+    def remove_game_unsafe(gid):
+        game = orig_remove(gid)
+        if game: acct["ended"] += 1
+        return game
+    def settle(game):
+        with lock:
+            if id(game) in settled: errors.append(f"game {game.gid} settled twice")
+            settled[id(game)] = game
+    def refund_game(game):
+        settle(game)
+        orig_refund(game)
+    def process_turn(game, mover, outcome, board, win=""):
+        if outcome == "win": settle(game) # draw refund_game se settle hota hai
+        orig_process(game, mover, outcome, board, win)
+    A.update_score, A.try_debit, A.add_game_unsafe, A.remove_game_unsafe = update_score, try_debit, add_game_unsafe, remove_game_unsafe
+    A.refund_game, A.process_turn = refund_game, process_turn
+
+    A.start_engine()
+    rooms, users = [], []
+    for r in range(args.rooms):
+        bot = A.new_room("TitanBot", "x", f"stress{r}", "http://localhost/")
+        bot["status"] = "ONLINE"
+        A.ROOMS[bot["key"]] = bot
+        rooms.append(bot)
+        users.append([f"u{r}_{i}" for i in range(args.users)])
+    for group in users:
+        for u in group: A.update_score(u, 0) # sabko 100 ka starting balance
+    A.flush_ledger()
+    acct["credits"] = 0
+    total_users = sum(len(g) for g in users)
+
+    def check_boards():
+        with A.GAME_LOCK:
+            A.check_indexes_unsafe()
+            games = list(A.ACTIVE_GAMES.values())
+        for g in games:
+            with g.lock:
+                if g.over: continue # abhi settle ho raha hai
+                nx, no = bin(g.x).count("1"), bin(g.o).count("1")
+                if g.x & g.o: errors.append(f"{g.gid}: cell with both marks")
+                if nx - no not in (0, 1): errors.append(f"{g.gid}: X={nx} O={no}")
+                if any(A.find_run(m, i, g.n, g.k) for m in (g.x, g.o) for i in range(g.n * g.n) if m >> i & 1):
+                    errors.append(f"{g.gid}: finished line on an active game")
+
+    rng = random.Random(args.seed)
+    stop = time.time() + args.duration
+    sent = [0]
+    def hammer(seed):
+        r = random.Random(seed)
+        while time.time() < stop:
+            i = r.randrange(len(rooms))
+            bot, u = rooms[i], r.choice(users[i])
+            roll = r.random()
+            if roll < 0.08: body = "!start"
+            elif roll < 0.12: body = "!start b easy"
+            elif roll < 0.14: body = "!start bet 10"
+            elif roll < 0.15: body = r.choice(("!start 4x4", "!start b 5x5 k4", "!start b gomoku"))
+            elif roll < 0.22: body = f"!join {r.choice(users[i])}"
+            elif roll < 0.24: body = "!stop"
+            elif roll < 0.30: body = "%s%d" % (r.choice("abcde"), r.randint(1, 5))
+            else: body = str(r.randint(1, 9))
+            A.dispatch_message(bot, u, body)
+            sent[0] += 1
+            if r.random() < 0.01: time.sleep(0.001)
+
+    t0 = time.time()
+    threads = [threading.Thread(target=hammer, args=(rng.random(),)) for _ in range(args.threads)]
+    for t in threads: t.start()
+    while any(t.is_alive() for t in threads):
+        check_boards()
+        time.sleep(0.05)
+    sent_at = time.time()
+    while A.GAME_EXECUTOR.pending(): time.sleep(0.01)
+    processed = time.time() - t0
+    # Saare games timeout se khatam hone do
+    deadline = time.time() + 10
+    while A.ACTIVE_GAMES and time.time() < deadline: time.sleep(0.05)
+    time.sleep(0.2)
+    check_boards()
+    A.flush_ledger()
+
+    with A.GAME_LOCK: active = len(A.ACTIVE_GAMES)
+    if acct["started"] != acct["ended"] + active: errors.append(f"started {acct['started']} != ended {acct['ended']} + active {active}")
+    if active: errors.append(f"{active} games never ended")
+    balances = {u: A.get_balance(u) for g in users for u in g}
+    stored = {u: A.get_score(u) for u in balances}
+    if balances != stored: errors.append(f"balance cache != DB for {sum(balances[u] != stored[u] for u in balances)} users")
+    if any(b < 0 for b in balances.values()): errors.append("negative balance")
+    expected = 100 * total_users + acct["credits"] # credits me debits (-amount) bhi hain
+    if sum(balances.values()) != expected: errors.append(f"balance sum {sum(balances.values())} != expected {expected}")
+
+    print(f"{sent[0]} messages from {args.threads} threads in {sent_at - t0:.1f}s, drained in {processed:.1f}s ({sent[0]/processed:.0f} msg/s)")
+    print(f"games started {acct['started']}, ended {acct['ended']}, settled {len(settled)}; debits {acct['debits']}, net balance delta {acct['credits']}")
+    if errors:
+        print("INVARIANTS FAILED:")
+        for e in errors[:20]: print("  " + e)
+        return 1
+    print("INVARIANTS OK")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())